@@ -0,0 +1,594 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+import discord
+
+from fake_gateway import STAFF, FakeChannel, FakeContext, FakeGuild, FakeInteraction, FakeMessage, make_guild_ids, shard_for
+
+
+def load_bot_module():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shard-manager.py')
+    spec = importlib.util.spec_from_file_location('shard_manager', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# The three-regex parser shard-manager.py used before the single-pass scanner; kept as the baseline.
+def legacy_parse_log_message(content):
+    target_match = re.search(r'Target\s*\n(.*?)(?=\n[A-Z]|$)', content, re.DOTALL)
+    type_match = re.search(r'Type\s*\n(.*?)(?=\n[A-Z]|$)', content, re.DOTALL)
+    issued_by_match = re.search(r'Issued By\s*\n(.*?)(?=\n[A-Z]|$)', content, re.DOTALL)
+
+    if target_match and type_match and issued_by_match:
+        return (
+            target_match.group(1).strip(),
+            type_match.group(1).strip(),
+            issued_by_match.group(1).strip()
+        )
+    return None
+
+
+LOG_FIELDS = ('Target', 'Type', 'Issued By')
+
+
+# The same fields read line by line in plain Python, with no regex; parse_log_message keeps its compiled scan because this is slower.
+def line_scan_parse_log_message(content):
+    if 'Issued By' not in content:
+        return None
+    values = {}
+    lines = content.split('\n')
+    last = len(lines) - 1
+    for index, line in enumerate(lines):
+        line = line.rstrip()
+        if index == last or not line.endswith(LOG_FIELDS):
+            continue
+        label = 'Target' if line.endswith('Target') else 'Type' if line.endswith('Type') else 'Issued By'
+        if label in values:
+            continue
+        start = index + 1
+        while start < last and not lines[start].strip():
+            start += 1
+        end = start + 1
+        while end <= last and not 'A' <= lines[end][:1] <= 'Z':
+            end += 1
+        values[label] = '\n'.join(lines[start:end]).strip()
+    if len(values) < len(LOG_FIELDS):
+        return None
+    return values['Target'], values['Type'], values['Issued By']
+
+
+REASONS = ["Hacking (killaura)", "Spam", "Toxicity in chat", "Ban evasion", "Advertising another server", "X-ray"]
+SERVERS = ["survival", "skyblock", "bedwars", "lobby-2"]
+
+
+def make_log_message(rng, staff_names):
+    return (
+        "**New Punishment**\n"
+        f"Target\n{rng.choice(['Steve', 'Alex', 'xX_Pvp_Xx', 'notch_fan'])}{rng.randint(1, 9999)}\n"
+        f"Type\n{rng.choice(['Ban', 'Mute', 'Kick', 'Warn'])}\n"
+        f"Reason\n{rng.choice(REASONS)}\n"
+        f"Duration\n{rng.choice(['Permanent', '7d', '1h', '30m'])}\n"
+        f"Issued By\n{rng.choice(staff_names)}\n"
+        f"Server\n{rng.choice(SERVERS)}"
+    )
+
+
+def make_chatter_message(rng):
+    words = ["anyone", "seen", "the", "appeal", "for", "that", "ban", "target", "type", "lol", "ok"]
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(3, 40)))
+
+
+def make_payloads(count, chatter_ratio, seed):
+    rng = random.Random(seed)
+    staff_names = [f"Mod{i}" for i in range(40)]
+    return [
+        make_chatter_message(rng) if rng.random() < chatter_ratio else make_log_message(rng, staff_names)
+        for _ in range(count)
+    ]
+
+
+def measure(parser, payloads, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for content in payloads:
+            parser(content)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return len(payloads) / best
+
+
+# Parsers take turns round by round, so a noisy stretch on the machine slows every one of them rather than just one.
+def measure_interleaved(parsers, payloads, repeat):
+    rates = [0.0] * len(parsers)
+    for _ in range(repeat):
+        for index, parser in enumerate(parsers):
+            rates[index] = max(rates[index], measure(parser, payloads, 1))
+    return rates
+
+
+def bench_parser(args):
+    bot_module = load_bot_module()
+    payloads = make_payloads(args.messages, args.chatter, args.seed)
+
+    for parser in (bot_module.parse_log_message, line_scan_parse_log_message):
+        mismatches = sum(1 for content in payloads if parser(content) != legacy_parse_log_message(content))
+        if mismatches:
+            raise SystemExit(f"{parser.__name__} disagrees with the legacy parser on {mismatches} of {len(payloads)} payloads")
+
+    legacy_rate, line_rate, current_rate = measure_interleaved(
+        [legacy_parse_log_message, line_scan_parse_log_message, bot_module.parse_log_message], payloads, args.repeat)
+    print(f"Payloads: {len(payloads)} ({args.chatter:.0%} chatter), best of {args.repeat}")
+    print(f"Legacy regex parser: {legacy_rate:,.0f} msgs/sec")
+    print(f"Line-by-line parser: {line_rate:,.0f} msgs/sec ({line_rate / legacy_rate:.2f}x)")
+    print(f"Single-pass parser:  {current_rate:,.0f} msgs/sec")
+    print(f"Speedup: {current_rate / legacy_rate:.2f}x")
+
+
+def guild_payloads(guild_id, args):
+    return make_payloads(args.messages, args.chatter, args.seed * 1000003 + guild_id)
+
+
+def expected_totals(payloads):
+    totals = {}
+    for content in payloads:
+        parsed = legacy_parse_log_message(content)
+        if parsed and parsed[2] in STAFF and parsed[1] in ['Ban', 'Mute']:
+            totals[parsed[2]] = totals.get(parsed[2], 0) + (15 if parsed[1] == 'Ban' else 20)
+    return totals
+
+
+async def drive_guilds(bot_module, guild_ids, args):
+    traffic = []
+    for guild_id in guild_ids:
+        state = await bot_module.get_state(guild_id)
+        channel = FakeChannel(guild_id + 1, FakeGuild(guild_id))
+        state.log_channel_id = channel.id
+        state.persist_config('log_channel_id')
+        for staff_name in STAFF:
+            state.add_staff(staff_name)
+        traffic.append((channel, guild_payloads(guild_id, args)))
+
+    # Interleave the guilds the way a shard's event stream would.
+    first_id = discord.utils.time_snowflake(datetime.now(timezone.utc) - timedelta(hours=1))
+    for index in range(args.messages):
+        for offset, (channel, payloads) in enumerate(traffic):
+            message_id = first_id + (index * len(traffic) + offset) * 1000
+            await bot_module.on_message(FakeMessage(message_id, payloads[index], channel))
+    for state in list(bot_module.guild_states.values()):
+        await state.flush_data()
+
+
+def bench_cluster_worker(args):
+    shard_count = int(os.environ['SHARD_MANAGER_SHARD_COUNT'])
+    shard_ids = {int(shard_id) for shard_id in os.environ['SHARD_MANAGER_SHARD_IDS'].split(',')}
+    bot_module = load_bot_module()
+    bot_module.STORAGE_BACKEND = args.backend
+    guild_ids = [guild_id for guild_id in make_guild_ids(args.guilds) if shard_for(guild_id, shard_count) in shard_ids]
+    asyncio.run(drive_guilds(bot_module, guild_ids, args))
+    print(f"Worker {os.getpid()} (shards {sorted(shard_ids)}, {type(bot_module.bot).__name__}) fed {len(guild_ids)} guilds")
+
+
+async def verify(bot_module, args):
+    start = datetime.now() - timedelta(days=2)
+    mismatches = 0
+    grand_total = 0
+    for guild_id in make_guild_ids(args.guilds):
+        state = await bot_module.get_state(guild_id)
+        report = await state.build_report(start)
+        totals = {state.staff_name(staff_id): counts['Shards'] for staff_id, counts in report.items()}
+        expected = expected_totals(guild_payloads(guild_id, args))
+        if totals != expected:
+            mismatches += 1
+            print(f"Guild {guild_id}: report {totals} != expected {expected}")
+        grand_total += sum(totals.values())
+    return mismatches, grand_total
+
+
+def bench_cluster(args):
+    bot_module = load_bot_module()
+    with tempfile.TemporaryDirectory() as data_root:
+        command = [sys.executable, os.path.abspath(__file__), 'cluster-worker', '--guilds', str(args.guilds), '--messages', str(args.messages),
+                   '--chatter', str(args.chatter), '--seed', str(args.seed), '--backend', args.backend]
+        codes = bot_module.launch_cluster(args.workers, args.shards, command, cwd=data_root)
+        if any(codes):
+            raise SystemExit(f"Workers exited with {codes}")
+
+        # A fresh process view of the shared data directory, as any worker would see it after a restart.
+        os.chdir(data_root)
+        checker = load_bot_module()
+        checker.STORAGE_BACKEND = args.backend
+        mismatches, grand_total = asyncio.run(verify(checker, args))
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if mismatches:
+        raise SystemExit(f"{mismatches} of {args.guilds} guild reports disagree with the traffic that was sent")
+    print(f"{args.guilds} guilds over {args.shards} shards and {args.workers} workers: all reports match, {grand_total} shards in total")
+
+
+# Save/reload checks: each guild is described, written out, read back by a fresh module and described again.
+ROUNDTRIP_GUILD = 1 << 22
+
+
+def roundtrip_module(backend, snapshot_format):
+    bot_module = load_bot_module()
+    bot_module.STORAGE_BACKEND = backend
+    bot_module.SNAPSHOT_FORMAT = snapshot_format
+    return bot_module
+
+
+async def describe_guild(bot_module):
+    state = await bot_module.get_state(ROUNDTRIP_GUILD)
+    report = await state.build_report(datetime(2000, 1, 1))
+    return {
+        'staff': sorted(state.staff_name(staff_id) for staff_id in state.staff_list),
+        'config': {key: state.get_config(key) for key in ('log_channel_id', 'staff_role_id')},
+        'shards': {state.staff_name(staff_id): shards for staff_id, shards in state.staff_shards.items() if shards},
+        'report': {state.staff_name(staff_id): counts for staff_id, counts in report.items() if any(counts.values())},
+        'archived_months': sorted(state.archived_months),
+        'segments': sorted(os.listdir(state.archive_dir)) if os.path.isdir(state.archive_dir) else [],
+    }
+
+
+async def save_guilds(bot_module):
+    for state in list(bot_module.guild_states.values()):
+        await state.flush_data()
+        if bot_module.STORAGE_BACKEND != 'sqlite':
+            async with state.flush_lock:
+                await state.compact_snapshot()
+        await state.close()
+    bot_module.guild_states.clear()
+
+
+async def seed_roundtrip(bot_module, scenario):
+    if scenario == 'legacy':
+        # A name-keyed snapshot from before staff ids, without per-row points.
+        directory = os.path.join(bot_module.DATA_DIR, str(ROUNDTRIP_GUILD))
+        os.makedirs(directory)
+        punishments = [(datetime(2024, 5, 1 + i % 20, 12).isoformat(), STAFF[i % 3], ['Ban', 'Mute'][i % 2], f"target{i}", 10 ** 15 + i) for i in range(60)]
+        shards = {}
+        for _, staff_name, action_type, _, _ in punishments:
+            shards[staff_name] = shards.get(staff_name, 0) + bot_module.DEFAULT_POINTS[action_type]
+        with open(os.path.join(directory, bot_module.DATA_FILE), 'w') as f:
+            json.dump({'staff_shards': shards, 'staff_list': STAFF[:2], 'log_channel_id': 11, 'staff_role_id': 12, 'punishments': punishments}, f)
+        return
+    state = await bot_module.get_state(ROUNDTRIP_GUILD)
+    await state.write(state.configure, log_channel_id=11, staff_role_id=12)
+    staff_ids = [await state.write(state.add_staff, staff_name) for staff_name in STAFF[:3]]
+    if scenario == 'empty':
+        return
+    if scenario == 'best-time':
+        # Rows logged under two best-time windows, the first replaced by the second and the second then unset.
+        now = datetime.now()
+        await state.write(state.change_best_time, now - timedelta(hours=3), now + timedelta(days=5))
+        for i in range(20):
+            await state.write(state.log_punishment, 10 ** 15 + i, (staff_ids[i % 3], ['Ban', 'Mute'][i % 2], f"target{i}"), now - timedelta(hours=2, minutes=i))
+        await state.write(state.change_best_time, datetime.now(), now + timedelta(days=5))
+        for i in range(20, 40):
+            await state.write(state.log_punishment, 10 ** 15 + i, (staff_ids[i % 3], ['Ban', 'Mute'][i % 2], f"target{i}"), datetime.now())
+        earned = await describe_guild(bot_module)
+        await state.write(state.change_best_time, None, None)
+        # A later rule change rescores every row and must keep the bonus those rows earned.
+        await state.write(state.change_rule, 'rank_modifiers', lambda rank_modifiers: dict(rank_modifiers or {}, senior=1.5))
+        return earned
+    rng = random.Random(7)
+    timestamps = [datetime(2020, 1, 1) + timedelta(seconds=rng.randint(0, 120 * 86400)) for _ in range(300)]
+    if scenario == 'archived-hot':
+        timestamps += [datetime.now() - timedelta(days=rng.randint(1, 20)) for _ in range(100)]
+    for i, timestamp in enumerate(sorted(timestamps)):
+        action_type = rng.choice(['Ban', 'Mute'])
+        state.record_punishment(timestamp, rng.choice(staff_ids), action_type, f"target{i}", 10 ** 15 + i, bot_module.DEFAULT_POINTS[action_type])
+    await state.flush_data()
+    await state.apply_retention(datetime(2021, 1, 1))
+
+
+async def relog_archived(bot_module):
+    state = await bot_module.get_state(ROUNDTRIP_GUILD)
+    staff_id = min(state.staff_list)
+    # The first seeded row is archived; logging it again, or any new row dated in an archived month, must not count.
+    await state.write(state.log_punishment, 10 ** 15, (staff_id, 'Ban', 'target0'), datetime.now())
+    await state.write(state.log_punishment, 10 ** 16, (staff_id, 'Ban', 'late'), datetime(2020, 1, 15))
+
+
+async def expected_legacy(bot_module):
+    with open(os.path.join(bot_module.DATA_DIR, str(ROUNDTRIP_GUILD), bot_module.DATA_FILE)) as f:
+        data = json.load(f)
+    report = {}
+    for _, staff_name, action_type, _, _ in data['punishments']:
+        counts = report.setdefault(staff_name, {'Ban': 0, 'Mute': 0, 'Shards': 0})
+        counts[action_type] += 1
+        counts['Shards'] += bot_module.DEFAULT_POINTS[action_type]
+    return {'staff': sorted(data['staff_list']), 'config': {'log_channel_id': 11, 'staff_role_id': 12}, 'shards': data['staff_shards'],
+            'report': report, 'archived_months': [], 'segments': []}
+
+
+async def run_roundtrip(args, scenario, formats):
+    seeder = roundtrip_module(args.backend, formats[0])
+    expected = await seed_roundtrip(seeder, scenario)
+    if expected is None:
+        expected = await expected_legacy(seeder) if scenario == 'legacy' else await describe_guild(seeder)
+    await save_guilds(seeder)
+    failures = []
+    # Each load reads what the one before it wrote, and the last format is loaded twice so its own output is read back too.
+    for step, snapshot_format in enumerate(formats[1:] + formats[-1:]):
+        bot_module = roundtrip_module(args.backend, snapshot_format)
+        states = {'loaded': await describe_guild(bot_module)}
+        if scenario.startswith('archived'):
+            await relog_archived(bot_module)
+            states['relogged'] = await describe_guild(bot_module)
+        await save_guilds(bot_module)
+        for stage, got in states.items():
+            for key in expected:
+                if got[key] != expected[key]:
+                    failures.append(f"{scenario} ({' -> '.join(formats)}), load {step + 1} {stage}: {key} {got[key]} != {expected[key]}")
+    return failures
+
+
+def bench_roundtrip(args):
+    failures = []
+    checks = 0
+    format_orders = [('binary', 'binary'), ('json', 'binary'), ('binary', 'json')] if args.backend != 'sqlite' else [('binary', 'binary')]
+    for scenario in ['empty', 'archived', 'archived-hot', 'legacy', 'best-time']:
+        for formats in format_orders:
+            with tempfile.TemporaryDirectory(prefix='shard-manager-roundtrip-') as data_root:
+                os.chdir(data_root)
+                try:
+                    failures += asyncio.run(run_roundtrip(args, scenario, formats))
+                finally:
+                    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+            checks += 1
+    for failure in failures:
+        print(f"MISMATCH {failure}")
+    if failures:
+        raise SystemExit(f"{len(failures)} save/reload mismatches ({args.backend} backend)")
+    print(f"{checks} save/reload round trips on the {args.backend} backend: every state came back unchanged")
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_staff_update(rng, member_ids):
+    mode = rng.choice(['Joined', 'Joined', 'ReJoin', 'Demote', 'Blacklist'])
+    return f"Mention: <@{rng.choice(member_ids)}>\nMode: **{mode}**\nStaff: {rng.choice(['Discord', 'Minecraft'])}"
+
+
+async def seed_history(bot_module, state, count, rng, staff_ids):
+    now = datetime.now()
+    first_id = 10 ** 15
+    # History arrives in log order, oldest first, so it appends like the live channel does.
+    offsets = sorted((rng.uniform(3600, 90 * 86400) for _ in range(count)), reverse=True)
+    for i, offset in enumerate(offsets):
+        action_type = rng.choice(['Ban', 'Mute'])
+        timestamp = now - timedelta(seconds=offset)
+        state.record_punishment(timestamp, rng.choice(staff_ids), action_type, f"target{i}", first_id + i, 15 if action_type == 'Ban' else 20)
+        if i % 50000 == 0:
+            await state.flush_data()
+    await state.flush_data()
+    # flush_state would have compacted long before now; a restart reads that snapshot, not a million journal lines.
+    if bot_module.STORAGE_BACKEND == 'journal':
+        async with state.flush_lock:
+            await state.compact_snapshot()
+
+
+async def time_command(bot_module, guild, command, args, repeat, before=None):
+    samples = []
+    # The first run pays one-off costs (view setup, lazy boards); it is not counted.
+    for run in range(repeat + 1):
+        if before:
+            before()
+        ctx = FakeContext(bot_module.bot, guild, command)
+        started = time.perf_counter()
+        if await command.can_run(ctx):
+            await command.callback(ctx, *args)
+        if run:
+            samples.append(time.perf_counter() - started)
+    return samples
+
+
+async def drive_load(bot_module, args):
+    rng = random.Random(args.seed)
+    guild = FakeGuild(1 << 22, http_latency=args.http_latency)
+    log_channel = FakeChannel(11, guild)
+    update_channel = FakeChannel(12, guild)
+    member_ids = list(range(10 ** 6, 10 ** 6 + args.members))
+    for member_id in member_ids[:int(len(member_ids) * 0.9)]:
+        guild.add_member(member_id, cached=rng.random() < args.cached_members)
+
+    state = await bot_module.get_state(guild.id)
+    state.log_channel_id = log_channel.id
+    state.staff_update_channel_id = update_channel.id
+    state.weekly_start = datetime.now() - timedelta(days=7)
+    state.persist_config('log_channel_id', 'staff_update_channel_id', 'weekly_start')
+    staff_ids = [state.add_staff(staff_name) for staff_name in STAFF]
+
+    results = {}
+    started = time.perf_counter()
+    await seed_history(bot_module, state, args.history, rng, staff_ids)
+    results['history_seed_seconds'] = time.perf_counter() - started
+
+    # Reload from disk, as a restart with this much history would.
+    await state.close()
+    bot_module.guild_states.clear()
+    started = time.perf_counter()
+    state = await bot_module.get_state(guild.id)
+    results['history_load_seconds'] = time.perf_counter() - started
+
+    workers = [asyncio.create_task(bot_module.staff_update_worker(queue)) for queue in bot_module.staff_update_queues]
+    payloads = make_payloads(args.messages, args.chatter, args.seed)
+    first_id = discord.utils.time_snowflake(datetime.now(timezone.utc))
+    latencies = []
+    update_every = max(1, round(args.messages / args.staff_updates)) if args.staff_updates else None
+    updates_sent = 0
+    started = time.perf_counter()
+    for index, content in enumerate(payloads):
+        if update_every and index % update_every == 0 and updates_sent < args.staff_updates:
+            updates_sent += 1
+            await bot_module.on_message(FakeMessage(first_id + index * 1000 + 1, make_staff_update(rng, member_ids), update_channel))
+        message = FakeMessage(first_id + index * 1000, content, log_channel)
+        handler_started = time.perf_counter()
+        await bot_module.on_message(message)
+        latencies.append(time.perf_counter() - handler_started)
+        if args.rate:
+            await asyncio.sleep(max(0.0, started + (index + 1) / args.rate - time.perf_counter()))
+    elapsed = time.perf_counter() - started
+    results['ingest_msgs_per_sec'] = len(payloads) / elapsed
+    results['handler_p50_ms'] = percentile(latencies, 0.5) * 1000
+    results['handler_p99_ms'] = percentile(latencies, 0.99) * 1000
+
+    await asyncio.gather(*(queue.join() for queue in bot_module.staff_update_queues))
+    drained = time.perf_counter() - started
+    for worker in workers:
+        worker.cancel()
+    results['staff_updates_per_sec'] = updates_sent / drained if updates_sent else 0.0
+    results['staff_update_http_calls'] = guild.http_calls
+
+    started = time.perf_counter()
+    await state.flush_data()
+    results['flush_seconds'] = time.perf_counter() - started
+
+    staff_name = STAFF[0]
+    end = datetime.now().strftime('%Y-%m-%d')
+    month_ago = (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d')
+    for name, command, command_args, before in [
+        ('weekly_report_cold', bot_module.weekly_report, (), state.invalidate_renders),
+        ('weekly_report_cached', bot_module.weekly_report, (), None),
+        ('range_report_staff', bot_module.range_report, (month_ago, end, staff_name), state.invalidate_renders),
+        ('stafflist', bot_module.staff_list_command, (), state.invalidate_renders),
+        ('leaderboard_weekly_cold', bot_module.leaderboard, ('weekly',), state.drop_period_leaderboards),
+        ('leaderboard_weekly_live', bot_module.leaderboard, ('weekly',), None),
+    ]:
+        samples = await time_command(bot_module, guild, command, command_args, args.report_repeat, before)
+        results[f'{name}_p50_ms'] = percentile(samples, 0.5) * 1000
+        results[f'{name}_p99_ms'] = percentile(samples, 0.99) * 1000
+
+    # Slash command autocomplete answers every keystroke, so it is timed per prefix typed.
+    samples = []
+    interaction = FakeInteraction(guild)
+    for run in range(args.report_repeat):
+        for prefix in ('', 'm', 'mod', 'MOD1', 'x'):
+            started = time.perf_counter()
+            await bot_module.complete_staff_name(interaction, prefix)
+            samples.append(time.perf_counter() - started)
+    results['staff_autocomplete_p50_ms'] = percentile(samples, 0.5) * 1000
+    results['staff_autocomplete_p99_ms'] = percentile(samples, 0.99) * 1000
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+# Keys ending in _per_sec are better when higher; every other result is a cost.
+def find_regressions(results, baseline, tolerance):
+    regressions = []
+    for key, value in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        # Sub-0.1ms latencies move by large fractions on scheduler noise alone.
+        if key.endswith('_ms') and abs(value - previous) < 0.1:
+            continue
+        change = (value - previous) / previous
+        if (key.endswith('_per_sec') and change < -tolerance) or (not key.endswith('_per_sec') and change > tolerance):
+            regressions.append((key, previous, value, change))
+    return regressions
+
+
+def bench_load(args):
+    bot_module = load_bot_module()
+    bot_module.STORAGE_BACKEND = args.backend
+    print(f"Loading {args.history} stored punishments, then {args.messages} live messages ({args.backend} backend)")
+    with tempfile.TemporaryDirectory(prefix='shard-manager-bench-') as data_root:
+        os.chdir(data_root)
+        try:
+            results = asyncio.run(drive_load(bot_module, args))
+        finally:
+            os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    width = max(len(key) for key in results)
+    for key, value in results.items():
+        print(f"{key.ljust(width)}  {value:,.3f}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'config': {k: v for k, v in vars(args).items() if k != 'func'}, 'results': results}, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        changed = [key for key, value in baseline['config'].items() if key not in ('output', 'baseline', 'tolerance') and getattr(args, key, None) != value]
+        if changed:
+            print(f"Warning: baseline was recorded with different settings for {', '.join(changed)}")
+        regressions = find_regressions(results, baseline['results'], args.tolerance)
+        for key, previous, value, change in regressions:
+            print(f"REGRESSION {key}: {previous:,.3f} -> {value:,.3f} ({change:+.0%})")
+        if regressions:
+            raise SystemExit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for shard-manager.py")
+    subparsers = parser.add_subparsers(dest='suite', required=True)
+
+    parser_suite = subparsers.add_parser('parser', help="Compare the log parser against the legacy regex parser")
+    parser_suite.add_argument('--messages', type=int, default=20000)
+    parser_suite.add_argument('--chatter', type=float, default=0.2, help="Fraction of non-log messages")
+    parser_suite.add_argument('--repeat', type=int, default=5)
+    parser_suite.add_argument('--seed', type=int, default=1)
+    parser_suite.set_defaults(func=bench_parser)
+
+    load_suite = subparsers.add_parser('load', help="Drive the real handlers and commands against a fake guild and gateway")
+    load_suite.add_argument('--history', type=int, default=100000, help="Punishments already stored before the run (e.g. 1000000)")
+    load_suite.add_argument('--messages', type=int, default=20000, help="Live log channel messages to ingest")
+    load_suite.add_argument('--chatter', type=float, default=0.2, help="Fraction of non-log messages")
+    load_suite.add_argument('--staff-updates', type=int, default=500, help="Staff update messages mixed into the stream")
+    load_suite.add_argument('--rate', type=float, default=0, help="Messages per second to pace at (0 = as fast as possible)")
+    load_suite.add_argument('--members', type=int, default=2000)
+    load_suite.add_argument('--cached-members', type=float, default=0.8, help="Fraction of members in the gateway cache")
+    load_suite.add_argument('--http-latency', type=float, default=0.05, help="Seconds each fake REST call takes")
+    load_suite.add_argument('--report-repeat', type=int, default=20)
+    load_suite.add_argument('--backend', choices=['json', 'journal', 'sqlite'], default='journal')
+    load_suite.add_argument('--seed', type=int, default=1)
+    load_suite.add_argument('--output', help="Write results as JSON to this file")
+    load_suite.add_argument('--baseline', help="Compare against a previous --output file and fail on regressions")
+    load_suite.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative change before a result counts as a regression")
+    load_suite.set_defaults(func=bench_load)
+
+    roundtrip_suite = subparsers.add_parser('roundtrip', help="Save and reload empty, archived, legacy and best-time guild states and check nothing changes")
+    roundtrip_suite.add_argument('--backend', choices=['json', 'journal', 'sqlite'], default='journal')
+    roundtrip_suite.set_defaults(func=bench_roundtrip)
+
+    for name, help_text in [('cluster', "Run a local cluster on fake gateway traffic and check every guild's report"),
+                             ('cluster-worker', "One cluster worker; started by the cluster suite")]:
+        cluster_suite = subparsers.add_parser(name, help=help_text)
+        cluster_suite.add_argument('--workers', type=int, default=3)
+        cluster_suite.add_argument('--shards', type=int, default=6)
+        cluster_suite.add_argument('--guilds', type=int, default=24)
+        cluster_suite.add_argument('--messages', type=int, default=200, help="Messages per guild")
+        cluster_suite.add_argument('--chatter', type=float, default=0.2, help="Fraction of non-log messages")
+        cluster_suite.add_argument('--seed', type=int, default=1)
+        cluster_suite.add_argument('--backend', choices=['json', 'journal', 'sqlite'], default='journal')
+        cluster_suite.set_defaults(func=bench_cluster if name == 'cluster' else bench_cluster_worker)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import asyncio
+
+import discord
+
+
+# Stand-ins for the handful of discord.py objects the bot's handlers and commands touch, so benchmark.py can drive them offline.
+# Anything that would be a REST call awaits FakeGuild.http(), which sleeps for the configured latency and counts calls.
+class FakeResponse:
+    status = 404
+    reason = "Not Found"
+
+
+class FakeRole:
+    def __init__(self, role_id):
+        self.id = role_id
+
+
+class FakeMember(discord.Member):
+    def __init__(self, member_id, guild):
+        self.member_id = member_id
+        self.guild = guild
+        self.role_objects = []
+
+    @property
+    def id(self):
+        return self.member_id
+
+    @property
+    def roles(self):
+        return self.role_objects
+
+    async def add_roles(self, *roles, reason=None, atomic=True):
+        await self.guild.http()
+        self.role_objects.extend(roles)
+
+
+class FakeGuild:
+    def __init__(self, guild_id, http_latency=0.0):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.http_latency = http_latency
+        self.http_calls = 0
+        self.cached_members = {}
+        self.remote_members = {}
+        self.roles = {}
+
+    def add_member(self, member_id, cached):
+        member = FakeMember(member_id, self)
+        self.remote_members[member_id] = member
+        if cached:
+            self.cached_members[member_id] = member
+        return member
+
+    async def http(self):
+        self.http_calls += 1
+        await asyncio.sleep(self.http_latency)
+
+    def get_member(self, member_id):
+        return self.cached_members.get(member_id)
+
+    async def fetch_member(self, member_id):
+        await self.http()
+        if member_id not in self.remote_members:
+            raise discord.NotFound(FakeResponse(), "Unknown Member")
+        return self.remote_members[member_id]
+
+    def get_role(self, role_id):
+        return self.roles.setdefault(role_id, FakeRole(role_id))
+
+    async def ban(self, user, reason=None):
+        await self.http()
+
+    async def kick(self, user, reason=None):
+        await self.http()
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id
+        self.guild = guild
+        self.mention = f"<#{channel_id}>"
+
+
+class FakeAuthor:
+    def __init__(self, author_id=1, bot=True):
+        self.id = author_id
+        self.bot = bot
+        self.roles = []
+        self.sent = []
+
+    async def send(self, *args, **kwargs):
+        self.sent.append(kwargs)
+
+
+class FakeMessage:
+    def __init__(self, message_id, content, channel):
+        self.id = message_id
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = FakeAuthor()
+        self.embeds = []
+        self.created_at = discord.utils.snowflake_time(message_id)
+
+
+class FakeContext:
+    def __init__(self, bot, guild, command):
+        self.bot = bot
+        self.guild = guild
+        self.command = command
+        self.author = FakeAuthor(bot=False)
+        self.interaction = None
+        self.sent = []
+
+    async def send(self, *args, **kwargs):
+        self.sent.append(kwargs)
+
+    async def defer(self, ephemeral=False):
+        pass
+
+
+class FakeInteraction:
+    def __init__(self, guild):
+        self.guild_id = guild.id
+
+
+STAFF = [f"Mod{i}" for i in range(0, 40, 2)]
+
+
+def make_guild_ids(count):
+    # Spread the ids over the shard bits the same way real snowflakes land on shards.
+    return [((i + 1) << 22) | i for i in range(count)]
+
+
+def shard_for(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count
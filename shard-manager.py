@@ -1,32 +1,72 @@
 import discord
+from discord import app_commands
 from discord.ext import commands, tasks
 import re
 from datetime import datetime, timedelta
 import json
+import math
 import os
+import random
+import shutil
+import sqlite3
+import csv
+import gzip
+import io
+import tempfile
+import struct
+import mmap
+import time
 import asyncio
+import argparse
+import subprocess
+import signal
+import sys
+import inspect
+import unicodedata
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain
+from operator import itemgetter
+from aiohttp import web
+from array import array
+from typing import Literal
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True  
-bot = commands.Bot(command_prefix='.', intents=intents)
+# Cluster workers are told which gateway shards they own through the environment; see launch_cluster.
+SHARD_COUNT = int(os.environ.get('SHARD_MANAGER_SHARD_COUNT', 0)) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.environ['SHARD_MANAGER_SHARD_IDS'].split(',')] if os.environ.get('SHARD_MANAGER_SHARD_IDS') else None
+AUTO_SHARD = False  # one process running every shard Discord recommends
+if AUTO_SHARD or SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix='.', intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix='.', intents=intents)
 
 
 bot.remove_command('help')
 
 
-staff_shards = {}  
-staff_list = set() 
-log_channel_id = None  
-bot_log_channel_id = None  
-staff_update_channel_id = None  
-weekly_start = None
-stage_start = None
-best_time_start = None
-best_time_end = None
-punishments = []  
-staff_role_id = None  
+guild_states = {}
+guild_state_loads = {}
+stored_guilds = set()
+legacy_checked = False
+outbound_queue = asyncio.Queue()
+outbound_channel_queues = {}
+outbound_workers = {}
+outbound_sent = {}
+outbound_last_lag = 0.0
+staff_update_workers = []
+member_cache = OrderedDict()
+member_cache_stats = {'gateway_hits': 0, 'cache_hits': 0, 'not_found_hits': 0, 'fetches': 0}
 
 
 DISCORD_STAFF_ROLES = [1186282691180642374, 1186309153854074951, 1186339787041419334] 
@@ -42,116 +82,2090 @@ EMOJI_HELP = "📜"
 EMOJI_ROLE = "🛡️"
 
 
+DATA_DIR = "guilds"
 DATA_FILE = "bot_data.json"
+SNAPSHOT_FILE = "bot_data.snap"
+SNAPSHOT_FORMAT = "binary"  # "binary" or "json"; either is read back, the other file is removed on the next write
+SNAPSHOT_MAGIC = b"SMSNAP1\n"
+JOURNAL_FILE = "bot_data.journal"
+JOURNAL_OLD_FILE = "bot_data.journal.old"
+DB_FILE = "bot_data.db"
+ARCHIVE_DIR = "archive"
+STORAGE_BACKEND = "journal"  # "json", "journal" or "sqlite"
+FLUSH_INTERVAL = 5
+SNAPSHOT_INTERVAL = 300
+SNAPSHOT_MAX_RECORDS = 5000
+BACKFILL_BATCH_SIZE = 100
+OUTBOUND_BATCH_WINDOW = 2.0
+OUTBOUND_MAX_BATCH = 40
+OUTBOUND_EMBEDS_PER_MESSAGE = 10
+# Discord allows roughly 5 messages per 5 seconds in a channel; stay inside that instead of eating 429s.
+OUTBOUND_RATE_LIMIT = 5
+OUTBOUND_RATE_PERIOD = 5.0
+STAFF_UPDATE_WORKERS = 8
+STAFF_UPDATE_RETRIES = 4
+MEMBER_CACHE_SIZE = 2000
+MEMBER_CACHE_TTL = 600
+MEMBER_NOT_FOUND_TTL = 60
+STATE_IDLE_TIMEOUT = 1800
+WORKER_STOP_TIMEOUT = 30  # seconds a cluster worker gets to flush and close before it is killed
+RETENTION_DAYS = 365  # None keeps every punishment hot; otherwise whole months older than this move to archive segments
+RETENTION_INTERVAL = 3600
+LEADERBOARD_PAGE_SIZE = 10
+AUTOCOMPLETE_LIMIT = 25  # the most choices Discord shows
+AUTOCOMPLETE_WAIT = 2.0  # a state still loading after this answers empty instead of missing the 3s deadline
+SYNC_APP_COMMANDS = True
+PAGE_VIEW_TIMEOUT = 120
+EMBED_FIELD_LIMIT = 25
+RENDER_CACHE_SIZE = 32
+EXPORT_FORMATS = ('csv', 'jsonl')
+EXPORT_COLUMNS = ('timestamp', 'staff', 'staff_id', 'type', 'target', 'message_id', 'points')
+EXPORT_BATCH_ROWS = 5000
+EXPORT_SIZE_MARGIN = 1024 * 1024  # room for one more batch and the compressor's buffered output
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108  # None disables the endpoint; cluster workers add their first shard id
+LOOP_LAG_INTERVAL = 1.0
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+CONFIG_KEYS = ['log_channel_id', 'bot_log_channel_id', 'staff_update_channel_id', 'staff_role_id',
+               'weekly_start', 'stage_start', 'best_time_start', 'best_time_end',
+               'log_checkpoint', 'backfill_cursor',
+               'point_table', 'bonus_windows', 'staff_ranks', 'rank_modifiers']
+DATETIME_KEYS = ['weekly_start', 'stage_start', 'best_time_start', 'best_time_end']
+RULE_KEYS = ['best_time_start', 'best_time_end', 'point_table', 'bonus_windows', 'staff_ranks', 'rank_modifiers']
+# Keys that only record how far ingestion got; a burst of updates to one of them can be collapsed into a single record.
+CURSOR_KEYS = ['log_checkpoint', 'backfill_cursor']
+DEFAULT_POINTS = {'Ban': 15, 'Mute': 20}
+BEST_TIME_MULTIPLIER = 2
+LEADERBOARD_PERIODS = {'all': None, 'weekly': 'weekly_start', 'stage': 'stage_start'}
+ACTION_TYPES = ['Ban', 'Mute']
+ACTION_CODES = {action_type: code for code, action_type in enumerate(ACTION_TYPES)}
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+STAFF_MENTION_PATTERN = re.compile(r'<@!?(\d+)>')
+DAY_MICROS = 86400 * 1000000
+
+
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+metrics_counters = {}
+metrics_histograms = {}
+metrics_gauges = {}
+metrics_runner = None
+
+
+def count(name, amount=1, **labels):
+    key = (name, tuple(labels.items()))
+    metrics_counters[key] = metrics_counters.get(key, 0) + amount
+
+
+# Buckets are stored per slot (not cumulative) with the +Inf slot and the running sum at the end.
+def observe(name, seconds, **labels):
+    key = (name, tuple(labels.items()))
+    histogram = metrics_histograms.get(key)
+    if histogram is None:
+        histogram = metrics_histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+    histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+
+@contextmanager
+def timed(name, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+def quantile(name, q, **labels):
+    histogram = metrics_histograms.get((name, tuple(labels.items())))
+    if not histogram:
+        return None
+    target = q * sum(histogram[:-1])
+    seen = 0
+    for bound, slot in zip(LATENCY_BUCKETS + (LATENCY_BUCKETS[-1],), histogram[:-1]):
+        seen += slot
+        if seen >= target:
+            return bound
+    return LATENCY_BUCKETS[-1]
+
+
+def read_journal(path):
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A crash mid-append leaves a torn last line; everything before it is intact.
+                print(f"Skipping unreadable journal line in {path}")
+
+
+DB_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS punishments (
+    timestamp TEXT NOT NULL,
+    staff INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    target TEXT,
+    message_id INTEGER NOT NULL,
+    points INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_punishments_timestamp ON punishments (timestamp);
+CREATE INDEX IF NOT EXISTS idx_punishments_staff ON punishments (staff, timestamp);
+CREATE INDEX IF NOT EXISTS idx_punishments_message_id ON punishments (message_id);
+CREATE TABLE IF NOT EXISTS staff_members (id INTEGER PRIMARY KEY, name TEXT NOT NULL, user_id INTEGER, aliases TEXT NOT NULL, active INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS staff_totals (staff INTEGER PRIMARY KEY, shards INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS config (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS archives (month TEXT PRIMARY KEY);
+'''
+
+
+async def run_db(func, *args):
+    return await asyncio.get_running_loop().run_in_executor(db_executor, func, *args)
+
+
+def month_bounds(month):
+    opens = datetime.strptime(month, '%Y-%m')
+    return opens, (opens + timedelta(days=32)).replace(day=1)
+
+
+# Segment summaries hold (staff id, counts) pairs per day, since JSON object keys could only be strings.
+def merge_rollups(rollups, summary):
+    for day, per_staff in summary.items():
+        day = rollups.setdefault(datetime.fromisoformat(day).date() if isinstance(day, str) else day, {})
+        for staff, counts in per_staff:
+            totals = day.setdefault(staff, {'Ban': 0, 'Mute': 0})
+            for action_type, count in counts.items():
+                totals[action_type] += count
+
+
+# Log names match whatever their case, width or spacing.
+def normalize_staff_name(staff_name):
+    return ' '.join(unicodedata.normalize('NFKC', staff_name).casefold().split())
+
+
+def tally(report, staff_id, action_type, count, points):
+    if staff_id not in report:
+        report[staff_id] = {'Ban': 0, 'Mute': 0, 'Shards': 0}
+    report[staff_id][action_type] += count
+    report[staff_id]['Shards'] += points
+
+
+# Staff ordered by shard total; ranking holds (-shards, staff id) so bisect finds any entry without re-sorting.
+class Leaderboard:
+    def __init__(self, totals=()):
+        self.totals = {}
+        self.ranking = []
+        for staff_id, shards in totals:
+            self.set(staff_id, shards)
+
+    def __len__(self):
+        return len(self.ranking)
+
+    def set(self, staff_id, shards):
+        old = self.totals.get(staff_id)
+        if old is not None:
+            del self.ranking[bisect_left(self.ranking, (-old, staff_id))]
+        self.totals[staff_id] = shards
+        insort(self.ranking, (-shards, staff_id))
+
+    def add(self, staff_id, points):
+        self.set(staff_id, self.totals.get(staff_id, 0) + points)
+
+    def discard(self, staff_id):
+        old = self.totals.pop(staff_id, None)
+        if old is not None:
+            del self.ranking[bisect_left(self.ranking, (-old, staff_id))]
+
+    def rank(self, staff_id):
+        if staff_id not in self.totals:
+            return None
+        return bisect_left(self.ranking, (-self.totals[staff_id], staff_id)) + 1
+
+    def page(self, start, count):
+        return [(start + i + 1, staff_id, -shards) for i, (shards, staff_id) in enumerate(self.ranking[start:start + count])]
+
+
+# Staff names and aliases sorted by their normalized form, so every one starting with a typed prefix sits in one run after a bisect.
+class StaffIndex:
+    def __init__(self, members=()):
+        self.entries = sorted((normalize_staff_name(alias), alias, member['name']) for member in members for alias in [member['name']] + member['aliases'])
+
+    # (alias, staff name) pairs; the alias is the name itself unless another alias is what matched.
+    def complete(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        prefix = normalize_staff_name(prefix)
+        start = bisect_left(self.entries, (prefix,))
+        matches = []
+        for folded, alias, staff_name in self.entries[start:start + limit]:
+            if not folded.startswith(prefix):
+                break
+            matches.append((alias, staff_name))
+        return matches
+
+
+def to_micros(timestamp):
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+def from_micros(micros):
+    return EPOCH + timedelta(microseconds=micros)
+
+
+# Points per action type, bonus multipliers by time and modifiers by staff rank.
+# Bonus windows are half-open and may overlap; they are cut into elementary intervals at every window edge,
+# each holding the product of the windows covering it, so any timestamp's multiplier is one bisect away.
+class ScoringRules:
+    def __init__(self, point_table=None, bonus_windows=(), staff_ranks=None, rank_modifiers=None):
+        self.point_table = dict(DEFAULT_POINTS, **(point_table or {}))
+        self.bonus_windows = sorted(bonus_windows)
+        self.staff_ranks = staff_ranks or {}
+        self.rank_modifiers = rank_modifiers or {}
+        edges = sorted({edge for start, end, _ in self.bonus_windows for edge in (start, end)})
+        self.boundaries = [to_micros(edge) for edge in edges]
+        self.factors = []
+        for opens, closes in zip(edges, edges[1:]):
+            factor = 1.0
+            for start, end, multiplier in self.bonus_windows:
+                if start <= opens and closes <= end:
+                    factor *= multiplier
+            self.factors.append(factor)
+
+    def factor_micros(self, micros):
+        index = bisect_right(self.boundaries, micros) - 1
+        return self.factors[index] if 0 <= index < len(self.factors) else 1.0
+
+    def factor(self, timestamp):
+        return self.factor_micros(to_micros(timestamp))
+
+    # The multiplier for a whole day, or None when a window edge falls inside it and its rows must be scored one by one.
+    def day_factor(self, opens, closes):
+        if bisect_right(self.boundaries, to_micros(opens)) != bisect_left(self.boundaries, to_micros(closes)):
+            return None
+        return self.factor(opens)
 
+    def modifier(self, staff_id):
+        return self.rank_modifiers.get(self.staff_ranks.get(staff_id), 1.0)
 
-def load_data():
-    global staff_shards, staff_list, log_channel_id, bot_log_channel_id, staff_update_channel_id, weekly_start, stage_start, best_time_start, best_time_end, punishments, staff_role_id
-    if os.path.exists(DATA_FILE):
+    def points(self, action_type, timestamp, staff_id):
+        return round(self.point_table[action_type] * self.factor(timestamp) * self.modifier(staff_id))
+
+
+# In-memory punishments as typed columns sorted by timestamp, with staff names and targets interned to small ids.
+# Rows go in and come out as the usual (timestamp, staff, type, target, message_id, points) tuples.
+class PunishmentColumns:
+    COLUMNS = ('times', 'staff', 'types', 'targets', 'message_ids', 'points', 'ids', 'id_times')
+
+    def __init__(self, rows=()):
+        self.staff_keys = []
+        self.staff_slots = {}
+        self.target_names = []
+        self.target_name_ids = {}
+        self.times = array('q')
+        self.staff = array('i')
+        self.types = array('b')
+        self.targets = array('i')
+        self.message_ids = array('q')
+        self.points = array('i')
+        # A second copy of the message ids, sorted, so a lookup by id is a bisect rather than a dict entry per row.
+        self.ids = array('q')
+        self.id_times = array('q')
+        rows = sorted(rows, key=itemgetter(0))
+        if rows:
+            self.times = array('q', [to_micros(row[0]) for row in rows])
+            self.staff = array('i', [self.intern(row[1], self.staff_keys, self.staff_slots) for row in rows])
+            self.types = array('b', [ACTION_CODES[row[2]] for row in rows])
+            self.targets = array('i', [self.intern(row[3], self.target_names, self.target_name_ids) for row in rows])
+            self.message_ids = array('q', [row[4] for row in rows])
+            self.points = array('i', [row[5] for row in rows])
+            # Log order is usually id order too, in which case the id index is just a copy.
+            if all(previous < message_id for previous, message_id in zip(self.message_ids, self.message_ids[1:])):
+                self.ids = array('q', self.message_ids)
+                self.id_times = array('q', self.times)
+            else:
+                by_id = sorted(zip(self.message_ids, self.times))
+                self.ids = array('q', [message_id for message_id, _ in by_id])
+                self.id_times = array('q', [micros for _, micros in by_id])
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        for index in range(len(self.times)):
+            yield self.row(index)
+
+    def intern(self, value, names, name_ids):
+        name_id = name_ids.get(value)
+        if name_id is None:
+            name_id = name_ids[value] = len(names)
+            names.append(value)
+        return name_id
+
+    def row(self, index):
+        return (from_micros(self.times[index]), self.staff_keys[self.staff[index]], ACTION_TYPES[self.types[index]],
+                self.target_names[self.targets[index]], self.message_ids[index], self.points[index])
+
+    def insert(self, row):
+        timestamp, staff, action_type, target, message_id, points = row
+        micros = to_micros(timestamp)
+        staff_slot = self.staff_slots.get(staff)
+        if staff_slot is None:
+            staff_slot = self.intern(staff, self.staff_keys, self.staff_slots)
+        target_id = self.target_name_ids.get(target)
+        if target_id is None:
+            target_id = self.intern(target, self.target_names, self.target_name_ids)
+        if not self.times or micros >= self.times[-1]:
+            self.times.append(micros)
+            self.staff.append(staff_slot)
+            self.types.append(ACTION_CODES[action_type])
+            self.targets.append(target_id)
+            self.message_ids.append(message_id)
+            self.points.append(points)
+        else:
+            index = bisect_right(self.times, micros)
+            for column, value in zip((self.times, self.staff, self.types, self.targets, self.message_ids, self.points),
+                                     (micros, staff_slot, ACTION_CODES[action_type], target_id, message_id, points)):
+                column.insert(index, value)
+        if not self.ids or message_id > self.ids[-1]:
+            self.ids.append(message_id)
+            self.id_times.append(micros)
+        else:
+            index = bisect_left(self.ids, message_id)
+            self.ids.insert(index, message_id)
+            self.id_times.insert(index, micros)
+
+    def locate(self, message_id):
+        # Live messages are newer than everything stored, so most lookups miss here without a search.
+        if not self.ids or message_id > self.ids[-1]:
+            return None, None
+        index = bisect_left(self.ids, message_id)
+        if index == len(self.ids) or self.ids[index] != message_id:
+            return None, None
+        position = bisect_left(self.times, self.id_times[index])
+        while self.message_ids[position] != message_id:
+            position += 1
+        return index, position
+
+    def get(self, message_id):
+        _, position = self.locate(message_id)
+        return None if position is None else self.row(position)
+
+    def remove(self, message_id):
+        index, position = self.locate(message_id)
+        if position is None:
+            return None
+        row = self.row(position)
+        del self.ids[index]
+        del self.id_times[index]
+        for column in (self.times, self.staff, self.types, self.targets, self.message_ids, self.points):
+            del column[position]
+        return row
+
+    def bounds(self, start, end):
+        low = bisect_left(self.times, to_micros(start)) if start else 0
+        high = bisect_left(self.times, to_micros(end)) if end else len(self.times)
+        return low, high
+
+    def between(self, start, end):
+        return self.rows(*self.bounds(start, end))
+
+    def rows(self, low, high):
+        return [self.row(index) for index in range(low, min(high, len(self.times)))]
+
+    def remove_range(self, start, end):
+        low, high = self.bounds(start, end)
+        if low == high:
+            return 0
+        for name in ('times', 'staff', 'types', 'targets', 'message_ids', 'points'):
+            del getattr(self, name)[low:high]
+        opens, closes = to_micros(start), to_micros(end)
+        keep = [index for index, micros in enumerate(self.id_times) if not opens <= micros < closes]
+        self.ids = array('q', [self.ids[index] for index in keep])
+        self.id_times = array('q', [self.id_times[index] for index in keep])
+        return high - low
+
+    # A read-only copy of the rows in [start, end), without the id index; the name lists are shared, not copied.
+    def slice(self, start, end):
+        low, high = self.bounds(start, end)
+        columns = PunishmentColumns()
+        columns.staff_keys = self.staff_keys
+        columns.target_names = self.target_names
+        for name in ('times', 'staff', 'types', 'targets', 'message_ids', 'points'):
+            setattr(columns, name, getattr(self, name)[low:high])
+        return columns
+
+    # A read-only copy for snapshots: arrays are copied whole and the name lists shallowly, since they only ever grow.
+    def copy(self):
+        columns = PunishmentColumns()
+        columns.staff_keys = list(self.staff_keys)
+        columns.target_names = list(self.target_names)
+        for name in self.COLUMNS:
+            setattr(columns, name, array(getattr(self, name).typecode, getattr(self, name)))
+        return columns
+
+    # Data from before staff ids is keyed by name; names mapped to one staff member end up sharing a slot.
+    def rekey_staff(self, mapping):
+        keys = [mapping[staff] for staff in self.staff_keys]
+        self.staff_keys = list(dict.fromkeys(keys))
+        self.staff_slots = {staff: slot for slot, staff in enumerate(self.staff_keys)}
+        translate = [self.staff_slots[staff] for staff in keys]
+        if translate != list(range(len(keys))):
+            self.staff = array('i', [translate[slot] for slot in self.staff])
+
+    # Binary snapshots hold the columns back to back as raw machine values, so reading one back is a memcpy per column.
+    def write_columns(self, f):
+        for name in self.COLUMNS:
+            getattr(self, name).tofile(f)
+
+    def read_columns(self, view, rows, staff_keys, target_names, byteorder):
+        self.staff_keys = staff_keys
+        self.staff_slots = {staff: slot for slot, staff in enumerate(staff_keys)}
+        self.target_names = target_names
+        self.target_name_ids = {name: name_id for name_id, name in enumerate(target_names)}
+        offset = 0
+        for name in self.COLUMNS:
+            column = getattr(self, name)
+            size = rows * column.itemsize
+            column.frombytes(view[offset:offset + size])
+            if byteorder != sys.byteorder:
+                column.byteswap()
+            offset += size
+
+    # Points for rows [low, high) under the given rules; a NumPy array when NumPy is there, a list otherwise.
+    # Both multiply in the same order as ScoringRules.points, so every path rounds to the same integers.
+    def scores(self, low, high, rules):
+        table = [rules.point_table[action_type] for action_type in ACTION_TYPES]
+        modifiers = [rules.modifier(staff) for staff in self.staff_keys]
+        if np is None:
+            factor = rules.factor_micros
+            return [round(table[action] * factor(micros) * modifiers[name_id])
+                    for micros, name_id, action in zip(self.times[low:high], self.staff[low:high], self.types[low:high])]
+        # frombuffer views pin the arrays against resizing, so none of them may outlive the caller.
+        points = np.array(table, dtype=np.float64)[np.frombuffer(self.types, dtype=np.int8)[low:high]]
+        if rules.boundaries:
+            factors = np.array([1.0] + rules.factors + [1.0])
+            positions = np.searchsorted(np.array(rules.boundaries, dtype=np.int64), np.frombuffer(self.times, dtype=np.int64)[low:high], side='right')
+            points = points * factors[positions]
+        points = points * np.array(modifiers, dtype=np.float64)[np.frombuffer(self.staff, dtype=np.int32)[low:high]]
+        return np.rint(points).astype(np.int64)
+
+    def report(self, start, end=None, staff=None, rules=None):
+        low, high = self.bounds(start, end)
+        staff_slot = None
+        if staff is not None:
+            staff_slot = self.staff_slots.get(staff)
+            if staff_slot is None:
+                return {}
+        points = self.scores(low, high, rules)
+        if np is None:
+            return self.report_python(low, staff_slot, points)
+
+        slots = np.frombuffer(self.staff, dtype=np.int32)[low:high]
+        types = np.frombuffer(self.types, dtype=np.int8)[low:high]
+        if staff_slot is not None:
+            mask = slots == staff_slot
+            slots, types, points = slots[mask], types[mask], points[mask]
+        size = len(self.staff_keys)
+        bans = np.bincount(slots, weights=types == 0, minlength=size)
+        mutes = np.bincount(slots, weights=types == 1, minlength=size)
+        shards = np.bincount(slots, weights=points, minlength=size)
+        report = {}
+        for slot in np.flatnonzero(bans + mutes).tolist():
+            report[self.staff_keys[slot]] = {'Ban': int(bans[slot]), 'Mute': int(mutes[slot]), 'Shards': int(shards[slot])}
+        return report
+
+    def report_python(self, low, staff_slot, points):
+        totals = {}
+        for slot, action, row_points in zip(self.staff[low:], self.types[low:], points):
+            if staff_slot is not None and slot != staff_slot:
+                continue
+            counts = totals.get(slot)
+            if counts is None:
+                counts = totals[slot] = [0, 0, 0]
+            counts[action] += 1
+            counts[2] += row_points
+        return {self.staff_keys[slot]: {'Ban': bans, 'Mute': mutes, 'Shards': shards} for slot, (bans, mutes, shards) in totals.items()}
+
+    # Re-scores every hot row in one pass; with commit the stored points are replaced too. Returns shards per staff.
+    def rescore(self, rules, commit=False):
+        points = self.scores(0, len(self.times), rules)
+        totals = {}
+        if np is not None:
+            slots = np.frombuffer(self.staff, dtype=np.int32)
+            rows = np.bincount(slots, minlength=len(self.staff_keys))
+            shards = np.bincount(slots, weights=points, minlength=len(self.staff_keys))
+            for slot in np.flatnonzero(rows).tolist():
+                totals[self.staff_keys[slot]] = int(shards[slot])
+            points = array('i', points.astype(np.int32).tobytes())
+        else:
+            for slot, row_points in zip(self.staff, points):
+                totals[self.staff_keys[slot]] = totals.get(self.staff_keys[slot], 0) + row_points
+            points = array('i', points)
+        if commit:
+            self.points = points
+        return totals
+
+    # Per-day, per-staff action counts for the rollups, grouped in one pass instead of a dict update per row.
+    def daily_counts(self):
+        rollups = {}
+        if np is not None:
+            size = len(self.staff_keys)
+            keys = (np.frombuffer(self.times, dtype=np.int64) // DAY_MICROS * size + np.frombuffer(self.staff, dtype=np.int32)) * 2 + np.frombuffer(self.types, dtype=np.int8)
+            keys, counts = np.unique(keys, return_counts=True)
+            groups = zip(keys.tolist(), counts.tolist())
+        else:
+            groups = {}
+            for micros, slot, action in zip(self.times, self.staff, self.types):
+                key = (micros // DAY_MICROS * len(self.staff_keys) + slot) * 2 + action
+                groups[key] = groups.get(key, 0) + 1
+            groups = groups.items()
+        for key, count in groups:
+            day, rest = divmod(key, len(self.staff_keys) * 2)
+            day = rollups.setdefault((EPOCH + timedelta(days=day)).date(), {})
+            day.setdefault(self.staff_keys[rest // 2], {'Ban': 0, 'Mute': 0})[ACTION_TYPES[rest % 2]] = count
+        return rollups
+
+
+class GuildState:
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        # Guild id None is the legacy single-server layout: files in the working directory.
+        self.directory = os.path.join(DATA_DIR, str(guild_id)) if guild_id is not None else '.'
+        self.data_file = os.path.join(self.directory, DATA_FILE)
+        self.snapshot_file = os.path.join(self.directory, SNAPSHOT_FILE)
+        self.archive_dir = os.path.join(self.directory, ARCHIVE_DIR)
+        self.journal_file = os.path.join(self.directory, JOURNAL_FILE)
+        self.journal_old_file = os.path.join(self.directory, JOURNAL_OLD_FILE)
+        self.db_file = os.path.join(self.directory, DB_FILE)
+        # Staff are keyed by a stable id; names, aliases and Discord user ids only lead to it.
+        self.staff_members = {}
+        self.staff_aliases = {}
+        self.staff_users = {}
+        self.staff_shards = {}
+        self.staff_list = set()
+        self.staff_index = None
+        for key in CONFIG_KEYS:
+            setattr(self, key, None)
+        self.punishments = PunishmentColumns()
+        self.rollups = {}
+        self.archived_months = set()
+        self.archive_ranges = {}
+        self.segment_cache = None
+        self.rules = None
+        self.leaderboards = {}
+        self.render_cache = OrderedDict()
+        self.render_generation = 0
+        self.backfill_task = None
+        self.writes = deque()
+        self.writes_ready = asyncio.Event()
+        self.writing = False
+        self.writer_task = None
+        self.pending_writes = 0
+        self.journal_seq = 0
+        self.journal_records = 0
+        self.journal_handle = None
+        self.last_snapshot = time.monotonic()
+        self.pending_records = []
+        self.pending_config = {}
+        self.state_dirty = False
+        self.flush_lock = asyncio.Lock()
+        self.db_connection = None
+        self.last_used = time.monotonic()
+
+    def set_config(self, key, value):
+        if key not in CONFIG_KEYS:
+            raise KeyError(key)
+        if key in DATETIME_KEYS:
+            value = datetime.fromisoformat(value) if value else None
+        if key in RULE_KEYS:
+            self.rules = None
+        setattr(self, key, value)
+
+    def get_config(self, key):
+        value = getattr(self, key)
+        if key in DATETIME_KEYS:
+            return value.isoformat() if value else None
+        return value
+
+    def apply_snapshot(self, data):
+        self.staff_members = {}
+        self.staff_aliases = {}
+        self.staff_users = {}
+        for member in data.get('staff_members', []):
+            self.apply_staff_member(member)
+        self.staff_shards = {k: int(v) for k, v in dict(data.get('staff_shards', {})).items()}
+        self.staff_list = set(data.get('staff_list', []))
+        for key in CONFIG_KEYS:
+            self.set_config(key, data.get(key))
+        self.archived_months = set(data.get('archived_months', []))
+        if isinstance(data.get('punishments'), PunishmentColumns):
+            self.punishments = data['punishments']
+            return
+        # Snapshots written before points were stored per punishment fall back to base points.
+        self.punishments = PunishmentColumns(
+            (datetime.fromisoformat(p[0]), p[1], p[2], p[3], int(p[4]), int(p[5]) if len(p) > 5 else DEFAULT_POINTS[p[2]])
+            for p in data.get('punishments', [])
+        )
+
+    def apply_record(self, record):
+        op = record['op']
+        if op == 'punishment':
+            staff_id = record['staff']
+            self.staff_shards[staff_id] = self.staff_shards.get(staff_id, 0) + record['points']
+            self.punishments.insert((datetime.fromisoformat(record['timestamp']), staff_id, record['type'], record['target'], record['message_id'], record['points']))
+        elif op == 'punishment_remove':
+            punishment = self.punishments.remove(record['message_id'])
+            if punishment:
+                self.staff_shards[punishment[1]] = self.staff_shards.get(punishment[1], 0) - punishment[5]
+        elif op == 'archive':
+            self.punishments.remove_range(*month_bounds(record['month']))
+            self.archived_months.add(record['month'])
+        elif op == 'rescore':
+            # The config records before this one have already restored the rules it was scored with.
+            self.punishments.rescore(self.get_rules(), commit=True)
+            self.staff_shards = dict(record['staff_shards'])
+        elif op == 'config':
+            self.set_config(record['key'], record['value'])
+        elif op == 'staff':
+            self.apply_staff_member(record['member'])
+            if record['active']:
+                self.staff_list.add(record['member']['id'])
+            else:
+                self.staff_list.discard(record['member']['id'])
+        # Journals written before staff ids name the staff member instead; load_state re-keys what they restore.
+        elif op == 'staff_add':
+            self.staff_list.add(record['name'])
+        elif op == 'staff_remove':
+            self.staff_list.discard(record['name'])
+
+    def load_data(self):
+        data = {}
+        if os.path.exists(self.snapshot_file):
+            try:
+                data = self.read_snapshot()
+                print(f"Data loaded successfully from {self.snapshot_file}")
+            except Exception as e:
+                print(f"Error loading data: {e}")
+                return False
+        elif os.path.exists(self.data_file):
+            try:
+                with open(self.data_file, 'r') as f:
+                    data = json.load(f)
+                print(f"Data loaded successfully from {self.data_file}")
+            except Exception as e:
+                print(f"Error loading data: {e}")
+                return False
+        self.apply_snapshot(data)
+
+        applied_seq = data.get('journal_seq', 0)
+        self.journal_seq = applied_seq
+        self.journal_records = 0
+        for path in (self.journal_old_file, self.journal_file):
+            for record in read_journal(path):
+                self.journal_seq = max(self.journal_seq, record['seq'])
+                # Records at or below applied_seq are already in the snapshot or were re-written by a retried flush.
+                if record['seq'] > applied_seq:
+                    self.apply_record(record)
+                    applied_seq = record['seq']
+                    self.journal_records += 1
+        if self.journal_records:
+            print(f"Replayed {self.journal_records} journal records")
+        self.rollups = self.punishments.daily_counts()
+        return True
+
+    # Data written before staff ids is keyed by the names as logged. Each distinct name, up to case and spacing, becomes one
+    # staff member, spelled as in the staff list where it is there. Returns the name to id mapping, empty when there was nothing to re-key.
+    def migrate_staff(self):
+        ranks = self.staff_ranks if isinstance(self.staff_ranks, dict) else {}
+        names = {staff for staff in chain(self.staff_list, self.staff_shards, self.punishments.staff_keys, ranks) if isinstance(staff, str)}
+        if not names:
+            return {}
+        mapping = {}
+        for staff_name in sorted(names, key=lambda name: (name not in self.staff_list, name)):
+            staff_id = self.staff_aliases.get(normalize_staff_name(staff_name))
+            if staff_id is None:
+                staff_id = max(self.staff_members, default=0) + 1
+                self.apply_staff_member({'id': staff_id, 'name': staff_name, 'user_id': None, 'aliases': []})
+            mapping[staff_name] = staff_id
+        self.staff_list = {mapping[staff_name] for staff_name in self.staff_list}
+        shards = {}
+        for staff_name, total in self.staff_shards.items():
+            shards[mapping[staff_name]] = shards.get(mapping[staff_name], 0) + total
+        self.staff_shards = shards
+        self.punishments.rekey_staff(mapping)
+        if ranks:
+            self.staff_ranks = sorted({mapping[staff_name]: rank for staff_name, rank in ranks.items()}.items())
+        self.rules = None
+        # Rewriting a segment twice is harmless, so a crash part way through is picked up by the next load.
+        for month in sorted(self.archived_months):
+            try:
+                self.write_segment(month, [(row[0], mapping.get(row[1], row[1])) + row[2:] for row in self.read_segment(month)])
+            except Exception as e:
+                print(f"Error re-keying archive segment {month}: {e}")
+        self.segment_cache = None
+        print(f"Gave {len(self.staff_members)} staff members ids for {len(mapping)} logged names in {self.directory}")
+        return mapping
+
+    # A day's counts are replaced rather than changed in place, so a report that copied the day list reads one consistent version.
+    def rollup_add(self, timestamp, staff_id, action_type, count=1):
+        day = dict(self.rollups.get(timestamp.date(), {}))
+        counts = dict(day.get(staff_id, {'Ban': 0, 'Mute': 0}))
+        counts[action_type] += count
+        if any(counts.values()):
+            day[staff_id] = counts
+        else:
+            day.pop(staff_id, None)
+        if day:
+            self.rollups[timestamp.date()] = day
+        else:
+            self.rollups.pop(timestamp.date(), None)
+
+    # Shallow copies only; the expensive isoformat/JSON work happens in write_snapshot off the event loop.
+    def snapshot_data(self):
+        data = {
+            'staff_members': list(self.staff_members.values()),
+            'staff_shards': list(self.staff_shards.items()),
+            'staff_list': list(self.staff_list),
+            'archived_months': sorted(self.archived_months),
+            'punishments': self.punishments.copy(),
+            'journal_seq': self.journal_seq
+        }
+        for key in CONFIG_KEYS:
+            data[key] = self.get_config(key)
+        return data
+
+    def write_snapshot(self, data):
+        if SNAPSHOT_FORMAT == 'binary':
+            path, stale = self.snapshot_file, self.data_file
+            columns = data['punishments']
+            header = dict(data, punishments=None, rows=len(columns), staff_keys=columns.staff_keys,
+                          target_names=columns.target_names, byteorder=sys.byteorder)
+            header = json.dumps(header).encode()
+            with open(path + '.tmp', 'wb') as f:
+                f.write(SNAPSHOT_MAGIC + struct.pack('<Q', len(header)) + header)
+                columns.write_columns(f)
+                f.flush()
+                os.fsync(f.fileno())
+        else:
+            path, stale = self.data_file, self.snapshot_file
+            data = dict(data, punishments=[(p[0].isoformat(), p[1], p[2], p[3], p[4], p[5]) for p in data['punishments']])
+            with open(path + '.tmp', 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        # Only now is the other format's file out of date; until the replace it was still the newest snapshot.
+        if os.path.exists(stale):
+            os.remove(stale)
+
+    # Timestamps stay int64 microseconds in the mapped columns; a datetime is only built when a row is read.
+    def read_snapshot(self):
+        with open(self.snapshot_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+                raise ValueError(f"{self.snapshot_file} is not a snapshot file")
+            start = len(SNAPSHOT_MAGIC) + 8
+            header_size, = struct.unpack('<Q', mapped[len(SNAPSHOT_MAGIC):start])
+            data = json.loads(mapped[start:start + header_size])
+            # Snapshots written before staff ids call the interned staff keys staff_names; an empty list is still a valid key table.
+            staff_keys = data.pop('staff_keys') if 'staff_keys' in data else data.pop('staff_names')
+            columns = PunishmentColumns()
+            with memoryview(mapped) as view:
+                columns.read_columns(view[start + header_size:], data.pop('rows'), staff_keys, data.pop('target_names'), data.pop('byteorder'))
+        data['punishments'] = columns
+        return data
+
+    def journal_write(self, records):
+        if self.journal_handle is None:
+            self.journal_handle = open(self.journal_file, 'a')
+        self.journal_handle.write(''.join(json.dumps(record) + '\n' for record in records))
+        self.journal_handle.flush()
+
+    def rotate_journal(self):
+        if self.journal_handle is not None:
+            self.journal_handle.close()
+            self.journal_handle = None
+        if not os.path.exists(self.journal_file):
+            return
+        if os.path.exists(self.journal_old_file):
+            # The previous snapshot never landed, so its journal is still needed.
+            with open(self.journal_old_file, 'a') as dst, open(self.journal_file, 'r') as src:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.journal_file)
+        else:
+            os.replace(self.journal_file, self.journal_old_file)
+
+    # Every db_* function runs on db_executor's single thread, never on the event loop.
+    def db_load(self):
+        if self.db_connection is None:
+            self.db_connection = sqlite3.connect(self.db_file, check_same_thread=False)
+            self.db_connection.executescript(DB_SCHEMA)
+        config = dict(self.db_connection.execute("SELECT key, value FROM config"))
+        has_punishments = self.db_connection.execute("SELECT 1 FROM punishments LIMIT 1").fetchone()
+        if not config and not has_punishments:
+            return None
+        data = {key: json.loads(value) for key, value in config.items()}
+        if self.db_connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'staff_shards'").fetchone():
+            # Written before staff ids: load_state re-keys these names and db_migrate_staff rewrites the tables.
+            data['legacy_staff'] = True
+            data['staff_list'] = [row[0] for row in self.db_connection.execute("SELECT name FROM staff")]
+            data['staff_shards'] = dict(self.db_connection.execute("SELECT name, shards FROM staff_shards"))
+            for staff_name, in self.db_connection.execute("SELECT DISTINCT staff FROM punishments"):
+                data['staff_shards'].setdefault(staff_name, 0)
+        else:
+            members = self.db_connection.execute("SELECT id, name, user_id, aliases, active FROM staff_members").fetchall()
+            data['staff_members'] = [{'id': staff_id, 'name': name, 'user_id': user_id, 'aliases': json.loads(aliases)} for staff_id, name, user_id, aliases, _ in members]
+            data['staff_list'] = [row[0] for row in members if row[4]]
+            data['staff_shards'] = self.db_connection.execute("SELECT staff, shards FROM staff_totals").fetchall()
+        data['archived_months'] = [row[0] for row in self.db_connection.execute("SELECT month FROM archives")]
+        return data
+
+    def db_import(self, data):
+        with self.db_connection:
+            self.db_connection.executemany(
+                "INSERT INTO punishments (timestamp, staff, type, target, message_id, points) VALUES (?, ?, ?, ?, ?, ?)",
+                [(p[0].isoformat(), p[1], p[2], p[3], p[4], p[5]) for p in data['punishments']]
+            )
+            self.db_connection.executemany("INSERT OR REPLACE INTO staff_members (id, name, user_id, aliases, active) VALUES (?, ?, ?, ?, ?)", [
+                (member['id'], member['name'], member['user_id'], json.dumps(member['aliases']), member['id'] in data['staff_list'])
+                for member in data['staff_members']
+            ])
+            self.db_connection.executemany("INSERT OR REPLACE INTO staff_totals (staff, shards) VALUES (?, ?)", data['staff_shards'])
+            self.db_connection.executemany("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", [(key, json.dumps(data[key])) for key in CONFIG_KEYS])
+            self.db_connection.executemany("INSERT OR IGNORE INTO archives (month) VALUES (?)", [(month,) for month in data['archived_months']])
+
+    def db_write(self, records):
+        with self.db_connection:
+            for record in records:
+                op = record['op']
+                if op == 'punishment':
+                    self.db_connection.execute(
+                        "INSERT INTO punishments (timestamp, staff, type, target, message_id, points) VALUES (?, ?, ?, ?, ?, ?)",
+                        (record['timestamp'], record['staff'], record['type'], record['target'], record['message_id'], record['points'])
+                    )
+                    self.db_connection.execute(
+                        "INSERT INTO staff_totals (staff, shards) VALUES (?, ?) "
+                        "ON CONFLICT (staff) DO UPDATE SET shards = shards + excluded.shards",
+                        (record['staff'], record['points'])
+                    )
+                elif op == 'punishment_remove':
+                    self.db_connection.execute("DELETE FROM punishments WHERE message_id = ?", (record['message_id'],))
+                    self.db_connection.execute("UPDATE staff_totals SET shards = shards - ? WHERE staff = ?", (record['points'], record['staff']))
+                elif op == 'archive':
+                    opens, closes = month_bounds(record['month'])
+                    self.db_connection.execute("DELETE FROM punishments WHERE timestamp >= ? AND timestamp < ?", (opens.isoformat(), closes.isoformat()))
+                    self.db_connection.execute("INSERT OR IGNORE INTO archives (month) VALUES (?)", (record['month'],))
+                elif op == 'config':
+                    self.db_connection.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (record['key'], json.dumps(record['value'])))
+                elif op == 'staff':
+                    member = record['member']
+                    self.db_connection.execute(
+                        "INSERT OR REPLACE INTO staff_members (id, name, user_id, aliases, active) VALUES (?, ?, ?, ?, ?)",
+                        (member['id'], member['name'], member['user_id'], json.dumps(member['aliases']), record['active'])
+                    )
+
+    # One transaction: punishments are copied into a table with an integer staff column and the name-keyed tables dropped.
+    def db_migrate_staff(self, mapping, data):
+        with self.db_connection:
+            self.db_connection.execute("BEGIN")
+            self.db_connection.execute("CREATE TEMP TABLE staff_keys (name TEXT PRIMARY KEY, staff INTEGER NOT NULL)")
+            self.db_connection.executemany("INSERT INTO staff_keys (name, staff) VALUES (?, ?)", list(mapping.items()))
+            self.db_connection.execute("ALTER TABLE punishments RENAME TO legacy_punishments")
+            for index in ('idx_punishments_timestamp', 'idx_punishments_staff', 'idx_punishments_message_id'):
+                self.db_connection.execute(f"DROP INDEX IF EXISTS {index}")
+            for statement in DB_SCHEMA.split(';'):
+                self.db_connection.execute(statement)
+            # Copied in rowid order, so export paging on (timestamp, rowid) keeps its order.
+            self.db_connection.execute(
+                "INSERT INTO punishments (timestamp, staff, type, target, message_id, points) "
+                "SELECT legacy.timestamp, staff_keys.staff, legacy.type, legacy.target, legacy.message_id, legacy.points "
+                "FROM legacy_punishments AS legacy JOIN staff_keys ON staff_keys.name = legacy.staff ORDER BY legacy.rowid"
+            )
+            self.db_connection.execute("DROP TABLE legacy_punishments")
+            self.db_connection.execute("DROP TABLE staff")
+            self.db_connection.execute("DROP TABLE staff_shards")
+            self.db_connection.executemany("INSERT OR REPLACE INTO staff_members (id, name, user_id, aliases, active) VALUES (?, ?, ?, ?, ?)", [
+                (member['id'], member['name'], member['user_id'], json.dumps(member['aliases']), member['id'] in data['staff_list'])
+                for member in data['staff_members']
+            ])
+            self.db_connection.executemany("INSERT OR REPLACE INTO staff_totals (staff, shards) VALUES (?, ?)", data['staff_shards'])
+            self.db_connection.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", ('staff_ranks', json.dumps(data['staff_ranks'])))
+        self.db_connection.execute("DROP TABLE temp.staff_keys")
+
+    def db_rollups(self):
+        result = {}
+        rows = self.db_connection.execute(
+            "SELECT substr(timestamp, 1, 10), staff, type, COUNT(*) FROM punishments GROUP BY 1, 2, 3"
+        )
+        for day, staff_id, action_type, count in rows:
+            counts = result.setdefault(datetime.fromisoformat(day).date(), {}).setdefault(staff_id, {'Ban': 0, 'Mute': 0})
+            counts[action_type] += count
+        return result
+
+    def db_punishments_between(self, start, end):
+        rows = self.db_connection.execute(
+            "SELECT timestamp, staff, type, target, message_id, points FROM punishments "
+            "WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp",
+            (start, end)
+        )
+        return [(datetime.fromisoformat(row[0]),) + row[1:] for row in rows]
+
+    # Keyset paging on (timestamp, rowid), so every page is one index seek however deep into the range it starts.
+    def db_punishments_page(self, after, end, limit):
+        return self.db_connection.execute(
+            "SELECT timestamp, staff, type, target, message_id, points, rowid FROM punishments "
+            "WHERE (timestamp > ? OR (timestamp = ? AND rowid > ?)) AND timestamp < ? ORDER BY timestamp, rowid LIMIT ?",
+            (after[0], after[0], after[1], end, limit)
+        ).fetchall()
+
+    def db_rescore(self, rules, archived, commit):
+        totals = {}
+        updates = []
+        for rowid, timestamp, staff_id, action_type, points in self.db_connection.execute("SELECT rowid, timestamp, staff, type, points FROM punishments"):
+            new_points = rules.points(action_type, datetime.fromisoformat(timestamp), staff_id)
+            totals[staff_id] = totals.get(staff_id, 0) + new_points
+            if new_points != points:
+                updates.append((new_points, rowid))
+        if commit:
+            shards = dict(archived)
+            for staff_id, points in totals.items():
+                shards[staff_id] = shards.get(staff_id, 0) + points
+            with self.db_connection:
+                self.db_connection.executemany("UPDATE punishments SET points = ? WHERE rowid = ?", updates)
+                self.db_connection.execute("UPDATE staff_totals SET shards = 0")
+                self.db_connection.executemany("INSERT OR REPLACE INTO staff_totals (staff, shards) VALUES (?, ?)", list(shards.items()))
+        return totals
+
+    def db_oldest_punishment(self):
+        return self.db_connection.execute("SELECT MIN(timestamp) FROM punishments").fetchone()[0]
+
+    def db_find_punishment(self, message_id):
+        row = self.db_connection.execute(
+            "SELECT timestamp, staff, type, target, message_id, points FROM punishments WHERE message_id = ?",
+            (message_id,)
+        ).fetchone()
+        return (datetime.fromisoformat(row[0]),) + row[1:] if row else None
+
+    def db_staff_totals(self):
+        return self.db_connection.execute(
+            "SELECT staff_members.id, COALESCE(staff_totals.shards, 0) FROM staff_members "
+            "LEFT JOIN staff_totals ON staff_totals.staff = staff_members.id WHERE staff_members.active"
+        ).fetchall()
+
+    async def query_db(self, func, *args):
+        # Reads must see mutations still waiting in the write-behind buffer.
+        await self.flush_data()
+        return await run_db(func, *args)
+
+    async def load_state(self):
+        await self.flush_data()
+        loaded = True
+        if STORAGE_BACKEND != 'sqlite':
+            loaded = self.load_data()
+            if self.migrate_staff():
+                # Written out straight away, so a journal never mixes name-keyed and id-keyed records.
+                self.rollups = self.punishments.daily_counts()
+                self.rotate_journal()
+                await asyncio.get_running_loop().run_in_executor(None, self.write_snapshot, self.snapshot_data())
+                if os.path.exists(self.journal_old_file):
+                    os.remove(self.journal_old_file)
+                self.journal_records = 0
+        else:
+            data = await run_db(self.db_load)
+            if data is None and any(os.path.exists(path) for path in (self.snapshot_file, self.data_file, self.journal_old_file, self.journal_file)):
+                # Files that could not be read are left for the next start to import, rather than replaced by an empty database.
+                loaded = self.load_data()
+                if loaded:
+                    self.migrate_staff()
+                    await run_db(self.db_import, self.snapshot_data())
+                    print(f"Imported {len(self.punishments)} punishments from {self.directory} into {self.db_file}")
+                    data = await run_db(self.db_load)
+            self.apply_snapshot(data or {})
+            if data and data.get('legacy_staff'):
+                await run_db(self.db_migrate_staff, self.migrate_staff(), self.snapshot_data())
+            self.rollups = await run_db(self.db_rollups)
+            print(f"Data loaded successfully from {self.db_file}")
+        self.load_archives(loaded)
+        self.leaderboards = {'all': Leaderboard((staff_id, self.staff_shards.get(staff_id, 0)) for staff_id in self.staff_list)}
+
+    def persist(self, *records):
+        for record in records:
+            if record['op'] == 'config' and record['key'] in self.pending_config:
+                # A cursor is last-writer-wins, so a burst of checkpoint updates collapses into one record.
+                self.pending_config[record['key']]['value'] = record['value']
+                continue
+            # Every other key keeps its place in the log: a rule value moved ahead of a later rescore would be replayed into it.
+            if record['op'] == 'config' and record['key'] in CURSOR_KEYS:
+                self.pending_config[record['key']] = record
+            self.journal_seq += 1
+            record['seq'] = self.journal_seq
+            self.pending_records.append(record)
+        self.state_dirty = True
+
+    def take_pending(self):
+        records = self.pending_records
+        self.pending_records = []
+        self.pending_config = {}
+        self.state_dirty = False
+        self.journal_records += len(records)
+        snapshot = self.snapshot_data() if STORAGE_BACKEND == 'json' else None
+        return records, snapshot
+
+    def write_pending(self, records, snapshot):
+        if STORAGE_BACKEND == 'sqlite':
+            self.db_write(records)
+        elif STORAGE_BACKEND == 'journal':
+            self.journal_write(records)
+        else:
+            self.write_snapshot(snapshot)
+
+    async def flush_data(self):
+        async with self.flush_lock:
+            if not self.state_dirty:
+                return
+            records, snapshot = self.take_pending()
+            executor = db_executor if STORAGE_BACKEND == 'sqlite' else None
+            try:
+                with timed('persist_seconds', kind='flush'):
+                    await asyncio.get_running_loop().run_in_executor(executor, self.write_pending, records, snapshot)
+                count('persisted_records_total', len(records))
+            except Exception as e:
+                count('persist_errors_total')
+                print(f"Error flushing data: {e}")
+                self.pending_records = records + self.pending_records
+                self.state_dirty = True
+
+    def save_data_to_file(self):
+        if not self.state_dirty:
+            return
+        records, snapshot = self.take_pending()
         try:
-            with open(DATA_FILE, 'r') as f:
-                data = json.load(f)
-            staff_shards = {k: int(v) for k, v in data.get('staff_shards', {}).items()}
-            staff_list = set(data.get('staff_list', []))
-            log_channel_id = data.get('log_channel_id')
-            bot_log_channel_id = data.get('bot_log_channel_id')
-            staff_update_channel_id = data.get('staff_update_channel_id')
-            staff_role_id = data.get('staff_role_id')
-            weekly_start = datetime.fromisoformat(data['weekly_start']) if data.get('weekly_start') else None
-            stage_start = datetime.fromisoformat(data['stage_start']) if data.get('stage_start') else None
-            best_time_start = datetime.fromisoformat(data['best_time_start']) if data.get('best_time_start') else None
-            best_time_end = datetime.fromisoformat(data['best_time_end']) if data.get('best_time_end') else None
-            punishments = [(datetime.fromisoformat(p[0]), p[1], p[2], p[3], int(p[4])) for p in data.get('punishments', [])]
-            print("Data loaded successfully from bot_data.json")
+            with timed('persist_seconds', kind='final'):
+                if STORAGE_BACKEND == 'sqlite':
+                    db_executor.submit(self.write_pending, records, snapshot).result()
+                else:
+                    self.write_pending(records, snapshot)
+            print(f"Flushed {len(records)} pending records")
         except Exception as e:
-            print(f"Error loading data: {e}")
-
-
-def save_data_to_file():
-    data = {
-        'staff_shards': staff_shards,
-        'staff_list': list(staff_list),
-        'log_channel_id': log_channel_id,
-        'bot_log_channel_id': bot_log_channel_id,
-        'staff_update_channel_id': staff_update_channel_id,
-        'staff_role_id': staff_role_id,
-        'weekly_start': weekly_start.isoformat() if weekly_start else None,
-        'stage_start': stage_start.isoformat() if stage_start else None,
-        'best_time_start': best_time_start.isoformat() if best_time_start else None,
-        'best_time_end': best_time_end.isoformat() if best_time_end else None,
-        'punishments': [(p[0].isoformat(), p[1], p[2], p[3], p[4]) for p in punishments]
-    }
-    try:
-        with open(DATA_FILE, 'w') as f:
-            json.dump(data, f, indent=4)
-        print("Data saved successfully to bot_data.json")
-    except Exception as e:
-        print(f"Error saving data: {e}")
+            print(f"Error saving data: {e}")
+
+    def persist_config(self, *keys):
+        if any(key in DATETIME_KEYS or key in RULE_KEYS for key in keys):
+            # Period boards and rendered reports depend on the period starts and the scoring rules.
+            self.rules = None
+            self.drop_period_leaderboards()
+            self.invalidate_renders()
+        self.persist(*[{'op': 'config', 'key': key, 'value': self.get_config(key)} for key in keys])
+
+    def configure(self, **values):
+        for key, value in values.items():
+            setattr(self, key, value)
+        self.persist_config(*values)
+
+    # Every change to the guild's state goes through here and is applied one at a time, in the order it was asked for.
+    # An action may await (a database lookup, an archive write) and nothing else changes state until it returns,
+    # while parsing, rendering and sends for other messages carry on concurrently. Actions must not call write().
+    async def write(self, action, *args, **kwargs):
+        self.pending_writes += 1
+        if not self.writing and not self.writes:
+            # Nothing is queued or being applied, so the change is made straight away without a hop through the writer task.
+            self.writing = True
+            try:
+                return await self.apply_write(action, args, kwargs)
+            finally:
+                self.writing = False
+                self.pending_writes -= 1
+                if self.writes:
+                    self.writes_ready.set()
+        done = asyncio.get_running_loop().create_future()
+        self.writes.append((action, args, kwargs, done))
+        if self.writer_task is None:
+            self.writer_task = asyncio.get_running_loop().create_task(self.run_writes())
+        self.writes_ready.set()
+        return await done
+
+    async def apply_write(self, action, args, kwargs):
+        result = action(*args, **kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    async def run_writes(self):
+        while True:
+            await self.writes_ready.wait()
+            self.writes_ready.clear()
+            while self.writes and not self.writing:
+                action, args, kwargs, done = self.writes.popleft()
+                self.writing = True
+                try:
+                    result = await self.apply_write(action, args, kwargs)
+                except Exception as e:
+                    # A caller that gave up waiting has already had its future cancelled.
+                    if not done.done():
+                        done.set_exception(e)
+                else:
+                    if not done.done():
+                        done.set_result(result)
+                finally:
+                    self.writing = False
+                    self.pending_writes -= 1
+
+    def apply_staff_member(self, member):
+        old = self.staff_members.get(member['id'])
+        if old is not None:
+            for alias in [old['name']] + old['aliases']:
+                if self.staff_aliases.get(normalize_staff_name(alias)) == old['id']:
+                    del self.staff_aliases[normalize_staff_name(alias)]
+            if old['user_id'] is not None and self.staff_users.get(old['user_id']) == old['id']:
+                del self.staff_users[old['user_id']]
+        self.staff_members[member['id']] = member
+        for alias in [member['name']] + member['aliases']:
+            self.staff_aliases[normalize_staff_name(alias)] = member['id']
+        if member['user_id'] is not None:
+            self.staff_users[member['user_id']] = member['id']
+        self.staff_index = None
+
+    # Members are replaced, never changed in place, so a record waiting to be flushed keeps the version it was made from.
+    def save_staff_member(self, member, active):
+        self.apply_staff_member(member)
+        if active:
+            self.staff_list.add(member['id'])
+        else:
+            self.staff_list.discard(member['id'])
+        self.render_cache.pop(('stafflist',), None)
+        self.persist({'op': 'staff', 'member': member, 'active': active})
+
+    def staff_name(self, staff_id):
+        member = self.staff_members.get(staff_id)
+        return member['name'] if member else f"#{staff_id}"
+
+    # A name or alias in any case or spacing, or a Discord mention, to a staff id with one dict lookup.
+    def resolve_staff(self, staff_name):
+        mention = STAFF_MENTION_PATTERN.fullmatch(staff_name.strip())
+        if mention:
+            return self.staff_users.get(int(mention.group(1)))
+        return self.staff_aliases.get(normalize_staff_name(staff_name))
+
+    def get_staff_index(self):
+        if self.staff_index is None:
+            self.staff_index = StaffIndex(self.staff_members[staff_id] for staff_id in self.staff_list)
+        return self.staff_index
+
+    # Adding a name that already leads to a staff member brings that member back, with their history.
+    def add_staff(self, staff_name):
+        staff_id = self.resolve_staff(staff_name)
+        if staff_id is None:
+            staff_id = max(self.staff_members, default=0) + 1
+            member = {'id': staff_id, 'name': staff_name, 'user_id': None, 'aliases': []}
+        else:
+            member = self.staff_members[staff_id]
+        self.save_staff_member(member, True)
+        # A returning staff member may already have punishments inside a period.
+        self.drop_period_leaderboards()
+        if 'all' in self.leaderboards and staff_id not in self.leaderboards['all'].totals:
+            self.leaderboards['all'].set(staff_id, self.staff_shards.get(staff_id, 0))
+        return staff_id
+
+    def remove_staff(self, staff_id):
+        self.save_staff_member(self.staff_members[staff_id], False)
+        for board in self.leaderboards.values():
+            board.discard(staff_id)
+
+    # Returns the member the alias already leads to instead of taking it from them.
+    def add_staff_alias(self, staff_id, alias):
+        owner = self.resolve_staff(alias)
+        if owner is not None:
+            return owner
+        member = self.staff_members[staff_id]
+        self.save_staff_member(dict(member, aliases=member['aliases'] + [alias]), staff_id in self.staff_list)
+        return None
+
+    def remove_staff_alias(self, staff_id, alias):
+        member = self.staff_members[staff_id]
+        aliases = [other for other in member['aliases'] if normalize_staff_name(other) != normalize_staff_name(alias)]
+        self.save_staff_member(dict(member, aliases=aliases), staff_id in self.staff_list)
+
+    # The old name stays an alias, so logs still using it keep counting. Like add_staff_alias, a name taken by another member is returned.
+    def rename_staff(self, staff_id, staff_name):
+        owner = self.resolve_staff(staff_name)
+        if owner is not None and owner != staff_id:
+            return owner
+        member = self.staff_members[staff_id]
+        aliases = [alias for alias in member['aliases'] if normalize_staff_name(alias) != normalize_staff_name(staff_name)]
+        if normalize_staff_name(member['name']) != normalize_staff_name(staff_name):
+            aliases.append(member['name'])
+        self.save_staff_member(dict(member, name=staff_name, aliases=aliases), staff_id in self.staff_list)
+        self.invalidate_renders()
+        return None
+
+    def link_staff_user(self, staff_id, user_id):
+        previous = self.staff_users.get(user_id)
+        if previous is not None and previous != staff_id:
+            self.save_staff_member(dict(self.staff_members[previous], user_id=None), previous in self.staff_list)
+        self.save_staff_member(dict(self.staff_members[staff_id], user_id=user_id), staff_id in self.staff_list)
+
+    # Rendered embed pages, keyed by report and kept until a punishment lands inside the window they cover.
+    def cached_render(self, key):
+        entry = self.render_cache.get(key)
+        if entry is None:
+            return None
+        self.render_cache.move_to_end(key)
+        return entry[2]
+
+    def store_render(self, key, start, end, pages, generation):
+        # Skip the store if something was invalidated while the report was being built.
+        if generation == self.render_generation:
+            self.render_cache[key] = (start, end, pages)
+            while len(self.render_cache) > RENDER_CACHE_SIZE:
+                self.render_cache.popitem(last=False)
+        return pages
+
+    def invalidate_renders(self, timestamp=None):
+        self.render_generation += 1
+        if timestamp is None:
+            self.render_cache.clear()
+            return
+        for key, (start, end, _) in list(self.render_cache.items()):
+            if (start is None or timestamp >= start) and (end is None or timestamp < end):
+                del self.render_cache[key]
+
+    def drop_period_leaderboards(self):
+        self.leaderboards = {period: board for period, board in self.leaderboards.items() if period == 'all'}
+
+    # 'all' follows stored shard totals; period boards are scored like build_report and only exist once asked for.
+    def update_leaderboards(self, timestamp, staff_id, action_type, points, count=1):
+        for period, board in self.leaderboards.items():
+            if staff_id not in board.totals:
+                continue
+            if period == 'all':
+                board.add(staff_id, points)
+            elif timestamp >= getattr(self, LEADERBOARD_PERIODS[period]):
+                board.add(staff_id, count * self.punishment_points(action_type, timestamp, staff_id))
+
+    async def leaderboard(self, period):
+        board = self.leaderboards.get(period)
+        if board is None:
+            start = getattr(self, LEADERBOARD_PERIODS[period])
+            if start is None:
+                return None
+            generation = self.render_generation
+            report = await self.build_report(start)
+            board = Leaderboard((staff_id, report[staff_id]['Shards'] if staff_id in report else 0) for staff_id in self.staff_list)
+            # A punishment logged while the report was built never reached this board, so it is only kept if none was.
+            if generation == self.render_generation:
+                self.leaderboards[period] = board
+        return board
+
+    def record_punishment(self, timestamp, staff_id, action_type, target, message_id, points):
+        self.staff_shards[staff_id] = self.staff_shards.get(staff_id, 0) + points
+        if STORAGE_BACKEND != 'sqlite':
+            self.punishments.insert((timestamp, staff_id, action_type, target, message_id, points))
+        self.rollup_add(timestamp, staff_id, action_type)
+        self.update_leaderboards(timestamp, staff_id, action_type, points)
+        self.invalidate_renders(timestamp)
+        self.persist({
+            'op': 'punishment',
+            'timestamp': timestamp.isoformat(),
+            'staff': staff_id,
+            'type': action_type,
+            'target': target,
+            'message_id': message_id,
+            'points': points
+        })
+
+    def remove_punishment(self, punishment):
+        timestamp, staff_id, action_type, _, message_id, points = punishment
+        self.staff_shards[staff_id] = self.staff_shards.get(staff_id, 0) - points
+        if STORAGE_BACKEND != 'sqlite':
+            self.punishments.remove(message_id)
+        self.rollup_add(timestamp, staff_id, action_type, -1)
+        self.update_leaderboards(timestamp, staff_id, action_type, -points, -1)
+        self.invalidate_renders(timestamp)
+        self.persist({'op': 'punishment_remove', 'message_id': message_id, 'staff': staff_id, 'points': points})
+
+    async def find_punishment(self, message_id):
+        if STORAGE_BACKEND == 'sqlite':
+            return await self.query_db(self.db_find_punishment, message_id)
+        return self.punishments.get(message_id)
+
+    # Rules as stored, with the best-time window as one more bonus window; overrides build a candidate set for previews.
+    def scoring_rules(self, **overrides):
+        config = {key: overrides.get(key, getattr(self, key)) for key in RULE_KEYS}
+        windows = [(datetime.fromisoformat(start), datetime.fromisoformat(end), multiplier) for start, end, multiplier in config['bonus_windows'] or []]
+        if config['best_time_start'] and config['best_time_end']:
+            windows.append((config['best_time_start'], config['best_time_end'] + MICROSECOND, BEST_TIME_MULTIPLIER))
+        return ScoringRules(config['point_table'], windows, dict(config['staff_ranks'] or []), config['rank_modifiers'])
+
+    def get_rules(self):
+        if self.rules is None:
+            self.rules = self.scoring_rules()
+        return self.rules
+
+    def punishment_points(self, action_type, timestamp, staff_id):
+        return self.get_rules().points(action_type, timestamp, staff_id)
+
+    def advance_checkpoint(self, message_id):
+        if self.log_checkpoint is None or message_id > self.log_checkpoint:
+            self.log_checkpoint = message_id
+            self.persist_config('log_checkpoint')
+
+    def parse_counted_punishment(self, message):
+        with timed('parse_seconds'):
+            parsed = parse_log_message(message.content, message.embeds)
+        if not parsed:
+            return None
+        target, action_type, staff_name = parsed
+        staff_id = self.resolve_staff(staff_name)
+        if staff_id not in self.staff_list or action_type not in ['Ban', 'Mute']:
+            return None
+        return staff_id, action_type, target
+
+    # The methods below run on the writer; messages are parsed before they are queued, so parsing never waits in line.
+    async def log_punishment(self, message_id, counted, timestamp):
+        # A message id is logged at most once, however often the gateway or a backfill delivers it.
+        if not counted or await self.find_punishment(message_id):
+            return None
+        # An archived month is closed: its counts are already in the segment, so a late or re-delivered row would count twice.
+        if timestamp.strftime('%Y-%m') in self.archived_months or await self.archived_punishment(message_id):
+            return None
+        staff_id, action_type, target = counted
+        points = self.punishment_points(action_type, timestamp, staff_id)
+        self.record_punishment(timestamp, staff_id, action_type, target, message_id, points)
+        count('punishments_ingested_total', type=action_type)
+        return staff_id, action_type, target, points
+
+    async def log_message(self, message_id, counted, timestamp):
+        logged = await self.log_punishment(message_id, counted, timestamp)
+        self.advance_checkpoint(message_id)
+        return logged
+
+    async def delete_punishment(self, message_id):
+        punishment = await self.find_punishment(message_id)
+        if punishment:
+            self.remove_punishment(punishment)
+        return punishment
+
+    # The old punishment is reversed and the edited one logged with no other change in between.
+    async def edit_punishment(self, message, counted):
+        previous = await self.find_punishment(message.id)
+        if not previous and not counted:
+            return False
+        if previous and counted == (previous[1], previous[2], previous[3]):
+            return False
+        if previous:
+            self.remove_punishment(previous)
+        timestamp = previous[0] if previous else local_time(message.created_at)
+        logged = await self.log_punishment(message.id, counted, timestamp)
+        return bool(previous or logged)
+
+    # Best time is not retroactive, so the window it replaces stays on as a bonus window until the new one starts, or until now when
+    # it is unset; a later rescore keeps what it earned.
+    def change_best_time(self, start, end):
+        values = {'best_time_start': start, 'best_time_end': end}
+        if self.best_time_start and self.best_time_end:
+            closes = min(self.best_time_end + MICROSECOND, start or datetime.now())
+            if closes > self.best_time_start:
+                window = [self.best_time_start.isoformat(), closes.isoformat(), BEST_TIME_MULTIPLIER]
+                values['bonus_windows'] = list(self.bonus_windows or []) + [window]
+        self.configure(**values)
+
+    # The new value is built from the current one here, so two commands changing the same rule both land.
+    async def change_rule(self, key, update):
+        self.configure(**{key: update(getattr(self, key))})
+        return await self.recompute_shards(commit=True)
+
+    async def fetch_punishments(self, start, end):
+        if STORAGE_BACKEND == 'sqlite':
+            return await self.query_db(self.db_punishments_between, start.isoformat(), end.isoformat())
+        return self.punishments.between(start, end)
+
+    # Rows in [start, end) a batch at a time, so an export never holds the whole range as tuples.
+    async def export_batches(self, start, end):
+        # Archived months come first, one decoded segment at a time; they are all older than the hot rows.
+        for month in sorted(self.archived_months):
+            opens, closes = month_bounds(month)
+            if closes > start and opens < end:
+                rows = await asyncio.get_running_loop().run_in_executor(None, self.archived_rows, max(opens, start), min(closes, end))
+                for low in range(0, len(rows), EXPORT_BATCH_ROWS):
+                    yield rows[low:low + EXPORT_BATCH_ROWS]
+        if STORAGE_BACKEND == 'sqlite':
+            await self.flush_data()
+            after = (start.isoformat(), -1)
+            while True:
+                page = await run_db(self.db_punishments_page, after, end.isoformat(), EXPORT_BATCH_ROWS)
+                if not page:
+                    return
+                after = (page[-1][0], page[-1][6])
+                yield [(datetime.fromisoformat(row[0]),) + row[1:6] for row in page]
+        else:
+            # Sliced up front, so rows logged while the export runs cannot shift it.
+            columns = self.punishments.slice(start, end)
+            for low in range(0, len(columns), EXPORT_BATCH_ROWS):
+                yield columns.rows(low, low + EXPORT_BATCH_ROWS)
+
+    async def build_report(self, start, end=None, staff=None, rules=None):
+        report = {}
+        rules = rules or self.get_rules()
+        for day, per_staff in list(self.rollups.items()):
+            opens = datetime(day.year, day.month, day.day)
+            closes = opens + timedelta(days=1)
+            if closes <= start or (end and opens >= end):
+                continue
+            multiplier = rules.day_factor(opens, closes)
+            if multiplier is not None and opens >= start and (end is None or closes <= end):
+                for staff_id, counts in per_staff.items():
+                    if staff and staff_id != staff:
+                        continue
+                    for action_type, count in counts.items():
+                        if count:
+                            tally(report, staff_id, action_type, count, round(rules.point_table[action_type] * multiplier * rules.modifier(staff_id)) * count)
+                continue
+
+            # The report window or a bonus window edge cuts through this day, so only its own rows are re-scored.
+            rows = []
+            if opens.strftime('%Y-%m') in self.archived_months:
+                rows = await asyncio.get_running_loop().run_in_executor(None, self.archived_rows, max(opens, start), min(closes, end or closes))
+            if STORAGE_BACKEND != 'sqlite':
+                for staff_id, totals in self.punishments.report(max(opens, start), min(closes, end or closes), staff, rules).items():
+                    tally(report, staff_id, 'Ban', totals['Ban'], totals['Shards'])
+                    tally(report, staff_id, 'Mute', totals['Mute'], 0)
+            else:
+                rows += await self.fetch_punishments(max(opens, start), min(closes, end or closes))
+            for timestamp, staff_id, action_type, _, _, _ in rows:
+                if staff and staff_id != staff:
+                    continue
+                tally(report, staff_id, action_type, 1, rules.points(action_type, timestamp, staff_id))
+        return report
+
+    # Shards per staff from the archive summaries; only days a bonus window edge cuts through decode their segment.
+    def archive_totals(self, rules, months):
+        totals = {}
+        for month in months:
+            for day, per_staff in self.read_segment_header(month)['summary'].items():
+                opens = datetime.fromisoformat(day)
+                closes = opens + timedelta(days=1)
+                multiplier = rules.day_factor(opens, closes)
+                if multiplier is None:
+                    for timestamp, staff_id, action_type, _, _, _ in self.read_segment(month):
+                        if opens <= timestamp < closes:
+                            totals[staff_id] = totals.get(staff_id, 0) + rules.points(action_type, timestamp, staff_id)
+                    continue
+                for staff_id, counts in per_staff:
+                    for action_type, count in counts.items():
+                        totals[staff_id] = totals.get(staff_id, 0) + round(rules.point_table[action_type] * multiplier * rules.modifier(staff_id)) * count
+        return totals
+
+    # Re-scores the whole history under the rules in one batched pass and returns {staff: (old, new)} for every change.
+    # Without commit it is a dry run; with it, stored points and staff_shards are replaced.
+    async def recompute_shards(self, rules=None, commit=False):
+        rules = rules or self.get_rules()
+        months = None
+        while months != self.archived_months:
+            months = set(self.archived_months)
+            totals = await asyncio.get_running_loop().run_in_executor(None, self.archive_totals, rules, sorted(months))
+        if STORAGE_BACKEND == 'sqlite':
+            await self.flush_data()
+            async with self.flush_lock:
+                hot = await run_db(self.db_rescore, rules, totals, commit)
+            # Rows still in the write-behind buffer are not in the database yet; they count on top.
+            for record in self.pending_records:
+                if record['op'] == 'punishment':
+                    points = rules.points(record['type'], datetime.fromisoformat(record['timestamp']), record['staff'])
+                    hot[record['staff']] = hot.get(record['staff'], 0) + points
+                elif record['op'] == 'punishment_remove':
+                    hot[record['staff']] = hot.get(record['staff'], 0) - record['points']
+        else:
+            # No await between re-scoring and replacing staff_shards, so no punishment can land in between.
+            hot = self.punishments.rescore(rules, commit)
+        for staff_id, points in hot.items():
+            totals[staff_id] = totals.get(staff_id, 0) + points
+
+        old = self.staff_shards
+        changes = {staff_id: (old.get(staff_id, 0), totals.get(staff_id, 0)) for staff_id in set(old) | set(totals)
+                   if old.get(staff_id, 0) != totals.get(staff_id, 0)}
+        if commit:
+            self.staff_shards = {staff_id: totals.get(staff_id, 0) for staff_id in set(old) | set(totals)}
+            if STORAGE_BACKEND != 'sqlite':
+                self.persist({'op': 'rescore', 'staff_shards': list(self.staff_shards.items())})
+            self.leaderboards = {'all': Leaderboard((staff_id, self.staff_shards.get(staff_id, 0)) for staff_id in self.staff_list)}
+            self.invalidate_renders()
+        return changes
+
+    async def compact_snapshot(self):
+        data = self.snapshot_data()
+        self.rotate_journal()
+        self.journal_records = 0
+        self.last_snapshot = time.monotonic()
+        try:
+            with timed('persist_seconds', kind='snapshot'):
+                await asyncio.get_running_loop().run_in_executor(None, self.write_snapshot, data)
+            if os.path.exists(self.journal_old_file):
+                os.remove(self.journal_old_file)
+            print(f"Snapshot written to {self.snapshot_file if SNAPSHOT_FORMAT == 'binary' else self.data_file}")
+        except Exception as e:
+            print(f"Error writing snapshot: {e}")
+
+    # Archive segments are gzipped JSONL: a header line with the month's per-day, per-staff counts, then its rows.
+    def segment_path(self, month):
+        return os.path.join(self.archive_dir, f"{month}.jsonl.gz")
+
+    def write_segment(self, month, rows):
+        message_ids = [min(p[4] for p in rows), max(p[4] for p in rows)]
+        summary = {}
+        for timestamp, staff, action_type, _, _, _ in rows:
+            counts = summary.setdefault(timestamp.date().isoformat(), {}).setdefault(staff, {'Ban': 0, 'Mute': 0})
+            counts[action_type] += 1
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = self.segment_path(month)
+        with open(path + '.tmp', 'wb') as raw:
+            with gzip.GzipFile(fileobj=raw, mode='wb') as f:
+                header = {'month': month, 'rows': len(rows), 'message_ids': message_ids, 'summary': {day: list(per_staff.items()) for day, per_staff in summary.items()}}
+                f.write((json.dumps(header) + '\n').encode())
+                f.write(''.join(json.dumps((p[0].isoformat(), p[1], p[2], p[3], p[4], p[5])) + '\n' for p in rows).encode())
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(path + '.tmp', path)
+        return message_ids
+
+    def read_segment_header(self, month):
+        with gzip.open(self.segment_path(month), 'rb') as f:
+            return json.loads(f.readline())
+
+    # Reads run on executor threads, so the cache entry is taken once and another thread replacing it cannot swap the rows returned.
+    def read_segment(self, month):
+        cache = self.segment_cache
+        if cache is None or cache[0] != month:
+            with gzip.open(self.segment_path(month), 'rb') as f:
+                f.readline()
+                rows = [(datetime.fromisoformat(p[0]), p[1], p[2], p[3], p[4], p[5]) for p in map(json.loads, f)]
+            cache = self.segment_cache = (month, rows)
+        return cache[1]
+
+    # Only the header line of each segment is decompressed; archived rows are decoded when a report needs part of a day.
+    def load_archives(self, loaded):
+        self.archive_ranges = {}
+        for month in sorted(self.archived_months):
+            try:
+                header = self.read_segment_header(month)
+                merge_rollups(self.rollups, header['summary'])
+                message_ids = header.get('message_ids')
+                if message_ids is None:
+                    # Segments written before the header kept their message id range are decoded once to find it.
+                    message_ids = [min(row[4] for row in self.read_segment(month)), max(row[4] for row in self.read_segment(month))]
+                self.archive_ranges[month] = message_ids
+            except Exception as e:
+                print(f"Error reading archive segment {month}: {e}")
+        if os.path.isdir(self.archive_dir):
+            # Months are archived oldest first, so a segment whose archive record never reached disk is newer than every archived month,
+            # and its rows are still in the hot set. After a failed load archived_months is empty and says nothing, so every segment stays.
+            last_archived = max(self.archived_months, default='')
+            for name in os.listdir(self.archive_dir):
+                month = name.split('.')[0]
+                if name.endswith('.tmp') or (loaded and month not in self.archived_months and month > last_archived):
+                    os.remove(os.path.join(self.archive_dir, name))
+
+    # Snowflakes grow with time, so live messages fall above every segment's range and never decode one.
+    async def archived_punishment(self, message_id):
+        for month, (low, high) in self.archive_ranges.items():
+            if low <= message_id <= high:
+                rows = await asyncio.get_running_loop().run_in_executor(None, self.read_segment, month)
+                if any(row[4] == message_id for row in rows):
+                    return True
+        return False
+
+    def archived_rows(self, start, end):
+        rows = []
+        for month in sorted(self.archived_months):
+            opens, closes = month_bounds(month)
+            if closes > start and opens < end:
+                rows.extend(row for row in self.read_segment(month) if start <= row[0] < end)
+        return rows
+
+    async def oldest_punishment(self):
+        if STORAGE_BACKEND == 'sqlite':
+            oldest = await self.query_db(self.db_oldest_punishment)
+            return datetime.fromisoformat(oldest) if oldest else None
+        return from_micros(self.punishments.times[0]) if len(self.punishments) else None
+
+    # Whole months older than the cutoff move to an immutable segment; nothing more is logged into a month once it is archived.
+    async def apply_retention(self, cutoff):
+        oldest = await self.oldest_punishment()
+        archived = 0
+        while oldest is not None:
+            month = oldest.strftime('%Y-%m')
+            opens, closes = month_bounds(month)
+            if closes > cutoff:
+                break
+            oldest = closes
+            if month in self.archived_months:
+                continue
+            rows = await self.fetch_punishments(opens, closes)
+            if not rows:
+                continue
+            message_ids = await asyncio.get_running_loop().run_in_executor(None, self.write_segment, month, rows)
+            if not await self.write(self.archive_month, month, len(rows), message_ids):
+                os.remove(self.segment_path(month))
+                continue
+            archived += len(rows)
+            print(f"Archived {len(rows)} punishments from {month} to {self.segment_path(month)}")
+        if archived:
+            count('archived_punishments_total', archived)
+        return archived
+
+    # Runs on the writer. A row landing in the month while the segment was written would be dropped with the rest; leave the month for next time.
+    async def archive_month(self, month, rows, message_ids):
+        opens, closes = month_bounds(month)
+        if len(await self.fetch_punishments(opens, closes)) != rows:
+            return False
+        if STORAGE_BACKEND != 'sqlite':
+            self.punishments.remove_range(opens, closes)
+        self.archived_months.add(month)
+        self.archive_ranges[month] = message_ids
+        self.persist({'op': 'archive', 'month': month})
+        return True
+
+    def files(self):
+        return self.data_file, self.snapshot_file, self.journal_old_file, self.journal_file, self.db_file
+
+    def idle(self):
+        return (
+            time.monotonic() - self.last_used >= STATE_IDLE_TIMEOUT
+            and not self.state_dirty
+            and not self.pending_writes
+            and not self.flush_lock.locked()
+            and (self.backfill_task is None or self.backfill_task.done())
+        )
+
+    async def close(self):
+        # Only idle states are closed, so nothing is left for the writer task to apply.
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+            self.writer_task = None
+        if self.journal_handle is not None:
+            self.journal_handle.close()
+            self.journal_handle = None
+        if self.db_connection is not None:
+            await run_db(self.db_connection.close)
+            self.db_connection = None
+
+
+# A guild's state is read from disk the first time it is needed and dropped again once it has been idle for a while.
+async def get_state(guild_id):
+    state = guild_states.get(guild_id)
+    if state is None:
+        loading = guild_state_loads.get(guild_id)
+        if loading is None:
+            loading = guild_state_loads[guild_id] = asyncio.get_running_loop().create_task(open_state(guild_id))
+        try:
+            state = await loading
+        finally:
+            guild_state_loads.pop(guild_id, None)
+    state.last_used = time.monotonic()
+    return state
+
+
+async def open_state(guild_id):
+    state = GuildState(guild_id)
+    os.makedirs(state.directory, exist_ok=True)
+    await state.load_state()
+    guild_states[guild_id] = state
+    stored_guilds.add(guild_id)
+    return state
+
+
+def find_stored_guilds():
+    if os.path.isdir(DATA_DIR):
+        stored_guilds.update(int(name) for name in os.listdir(DATA_DIR) if name.isdigit())
+
+
+# Data from the single-server layout sits in the working directory; move it under the guild that owns its log channel.
+async def claim_legacy_state():
+    legacy = GuildState(None)
+    if not any(os.path.exists(path) for path in legacy.files()):
+        return
+    await legacy.load_state()
+    await legacy.close()
+    channel = bot.get_channel(legacy.log_channel_id) if legacy.log_channel_id else None
+    # A cluster worker only sees its own shards' guilds, so "the only guild" proves nothing there.
+    guild = channel.guild if channel else bot.guilds[0] if len(bot.guilds) == 1 and SHARD_IDS is None else None
+    if guild is None or guild.id in stored_guilds:
+        print("Found legacy bot_data files but could not match them to a guild; leaving them in place")
+        return
+    state = GuildState(guild.id)
+    os.makedirs(state.directory, exist_ok=True)
+    for src, dst in zip(legacy.files(), state.files()):
+        if os.path.exists(src):
+            os.replace(src, dst)
+    stored_guilds.add(guild.id)
+    print(f"Moved legacy bot_data files to {state.directory}")
+
+
+def save_all_states():
+    for state in guild_states.values():
+        state.save_data_to_file()
+
+
+@tasks.loop(seconds=FLUSH_INTERVAL)
+async def flush_state():
+    for guild_id, state in list(guild_states.items()):
+        await state.flush_data()
+        if STORAGE_BACKEND == 'journal' and state.journal_records and (
+            state.journal_records >= SNAPSHOT_MAX_RECORDS or time.monotonic() - state.last_snapshot >= SNAPSHOT_INTERVAL
+        ):
+            async with state.flush_lock:
+                await state.compact_snapshot()
+        if state.idle():
+            del guild_states[guild_id]
+            await state.close()
+
+
+@tasks.loop(seconds=RETENTION_INTERVAL)
+async def apply_retention():
+    if RETENTION_DAYS is None:
+        return
+    cutoff = datetime.now() - timedelta(days=RETENTION_DAYS)
+    for state in list(guild_states.values()):
+        try:
+            await state.apply_retention(cutoff)
+        except Exception as e:
+            print(f"Error archiving punishments for guild {state.guild_id}: {e}")
 
 
 @tasks.loop(seconds=10)
 async def update_status():
     statuses = [
         discord.Activity(type=discord.ActivityType.watching, name=" Shards"),
-        discord.Activity(type=discord.ActivityType.watching, name=f" {len(staff_list)} Staff")
+        discord.Activity(type=discord.ActivityType.watching, name=f" {sum(len(state.staff_list) for state in guild_states.values())} Staff")
     ]
     for status in statuses:
         await bot.change_presence(status=discord.Status.dnd, activity=status)
         await asyncio.sleep(10)
 
 
+# Sleeping a fixed interval and measuring the overshoot shows how long callbacks hold the event loop.
+@tasks.loop(seconds=0)
+async def measure_loop_lag():
+    expected = time.monotonic() + LOOP_LAG_INTERVAL
+    await asyncio.sleep(LOOP_LAG_INTERVAL)
+    lag = max(0.0, time.monotonic() - expected)
+    metrics_gauges['event_loop_lag_last_seconds'] = lag
+    observe('event_loop_lag_seconds', lag)
+
+
+def collect_gauges():
+    gauges = [(name, (), value) for name, value in metrics_gauges.items()]
+    gauges.append(('outbound_queue_depth', (), outbound_depth()))
+    gauges.append(('outbound_last_lag_seconds', (), outbound_last_lag))
+    gauges.append(('staff_update_queue_depth', (), sum(queue.qsize() for queue in staff_update_queues)))
+    gauges.append(('guild_states_loaded', (), len(guild_states)))
+    gauges.append(('member_cache_entries', (), len(member_cache)))
+    latencies = bot.latencies if isinstance(bot, commands.AutoShardedBot) else [(0, bot.latency)]
+    for shard_id, latency in latencies:
+        if not math.isnan(latency):
+            gauges.append(('gateway_latency_seconds', (('shard', shard_id),), latency))
+    return gauges
+
+
+def prometheus_labels(labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}' if labels else ''
+
+
+def render_metrics():
+    lines = []
+    typed = set()
+
+    def declare(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE shard_manager_{name} {kind}")
+
+    counters = dict(metrics_counters)
+    for source, value in member_cache_stats.items():
+        counters[('member_lookups_total', (('source', source),))] = value
+    for (name, labels), value in sorted(counters.items()):
+        declare(name, 'counter')
+        lines.append(f"shard_manager_{name}{prometheus_labels(labels)} {value}")
+    for name, labels, value in sorted(collect_gauges()):
+        declare(name, 'gauge')
+        lines.append(f"shard_manager_{name}{prometheus_labels(labels)} {value}")
+    for (name, labels), histogram in sorted(metrics_histograms.items()):
+        declare(name, 'histogram')
+        cumulative = 0
+        for bound, slot in zip(LATENCY_BUCKETS + ('+Inf',), histogram[:-1]):
+            cumulative += slot
+            lines.append(f"shard_manager_{name}_bucket{prometheus_labels(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"shard_manager_{name}_sum{prometheus_labels(labels)} {histogram[-1]}")
+        lines.append(f"shard_manager_{name}_count{prometheus_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+async def metrics_handler(request):
+    return web.Response(body=render_metrics().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_metrics_server():
+    global metrics_runner
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    port = METRICS_PORT + (SHARD_IDS[0] if SHARD_IDS else 0)
+    try:
+        await web.TCPSite(metrics_runner, METRICS_HOST, port).start()
+        print(f"Metrics available at http://{METRICS_HOST}:{port}/metrics")
+    except OSError as e:
+        print(f"Could not start metrics endpoint on port {port}: {e}")
+
+
+def queue_punishment_log(state, staff_id, action_type, target, points, link):
+    if not state.bot_log_channel_id:
+        return
+    outbound_queue.put_nowait({
+        'queued_at': time.monotonic(),
+        'channel_id': state.bot_log_channel_id,
+        'staff': state.staff_name(staff_id),
+        'action': action_type,
+        'target': target,
+        'points': points,
+        'total': state.staff_shards.get(staff_id, 0),
+        'link': link
+    })
+
+
+def punishment_log_embed(item):
+    embed = discord.Embed(
+        title=f"{EMOJI_SUCCESS} Punishment Logged",
+        description=f"Staff {item['staff']} earned {item['points']} shards!",
+        color=discord.Color.green()
+    )
+    embed.add_field(name="Action", value=item['action'], inline=True)
+    embed.add_field(name="Target", value=item['target'], inline=True)
+    embed.add_field(name="Total Shards", value=item['total'], inline=True)
+    embed.add_field(name="Log", value=f"[View Log]({item['link']})", inline=False)
+    return embed
+
+
+def punishment_summary_embeds(items):
+    embeds = []
+    lines = []
+    for item in items:
+        line = f"**{item['staff']}** +{item['points']} ({item['action']} {item['target']}, total {item['total']}) [View Log]({item['link']})"
+        if lines and len('\n'.join(lines)) + len(line) + 1 > 4000:
+            embeds.append(lines)
+            lines = []
+        lines.append(line)
+    embeds.append(lines)
+    return [
+        discord.Embed(
+            title=f"{EMOJI_SUCCESS} {len(chunk)} Punishments Logged",
+            description='\n'.join(chunk),
+            color=discord.Color.green()
+        )
+        for chunk in embeds
+    ]
+
+
+async def wait_for_send_slot(channel_id):
+    sent = outbound_sent.setdefault(channel_id, deque())
+    while True:
+        now = time.monotonic()
+        while sent and now - sent[0] >= OUTBOUND_RATE_PERIOD:
+            sent.popleft()
+        if len(sent) < OUTBOUND_RATE_LIMIT:
+            sent.append(now)
+            return
+        await asyncio.sleep(OUTBOUND_RATE_PERIOD - (now - sent[0]))
+
+
+def outbound_depth():
+    return outbound_queue.qsize() + sum(queue.qsize() for queue in outbound_channel_queues.values())
+
+
+# Only hands each log to its channel's worker, so a channel waiting out its rate limit never holds back another guild's logs.
+@tasks.loop(seconds=0)
+async def send_outbound():
+    item = await outbound_queue.get()
+    channel_id = item['channel_id']
+    queue = outbound_channel_queues.setdefault(channel_id, asyncio.Queue())
+    if channel_id not in outbound_workers or outbound_workers[channel_id].done():
+        outbound_workers[channel_id] = asyncio.create_task(send_channel_outbound(channel_id, queue))
+    queue.put_nowait(item)
+
+
+async def send_channel_outbound(channel_id, queue):
+    global outbound_last_lag
+    while True:
+        batch = [await queue.get()]
+        deadline = time.monotonic() + OUTBOUND_BATCH_WINDOW
+        while len(batch) < OUTBOUND_MAX_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        channel = bot.get_channel(channel_id)
+        if not channel:
+            continue
+        # Up to 10 full embeds fit one message; a bigger wave is folded into compact summary embeds instead.
+        if len(batch) <= OUTBOUND_EMBEDS_PER_MESSAGE:
+            messages = [[punishment_log_embed(item) for item in batch]]
+        else:
+            messages = [[embed] for embed in punishment_summary_embeds(batch)]
+        for embeds in messages:
+            await wait_for_send_slot(channel_id)
+            try:
+                with timed('outbound_send_seconds'):
+                    await channel.send(embeds=embeds)
+                count('outbound_messages_total')
+            except discord.HTTPException as e:
+                count('outbound_errors_total')
+                print(f"HTTP error sending bot log message: {e}")
+        outbound_last_lag = time.monotonic() - batch[0]['queued_at']
+
+
 def check_staff_role():
     async def predicate(ctx):
-        if staff_role_id is None or ctx.command.name in ['setstaffrole', 'weeklyreport', 'stagereport', 'stafflist']:
+        if ctx.guild is None:
+            return False
+        state = await get_state(ctx.guild.id)
+        if state.staff_role_id is None or ctx.command.name in ['setstaffrole', 'weeklyreport', 'stagereport', 'stafflist', 'report', 'leaderboard']:
             return True
-        return any(role.id == staff_role_id for role in ctx.author.roles)
+        return any(role.id == state.staff_role_id for role in ctx.author.roles)
     return commands.check(predicate)
 
+# Slash invocations get a real ephemeral reply; a prefix command cannot have one, so its reply goes to the author's DMs instead.
+async def send_private(ctx, **kwargs):
+    if ctx.interaction is None:
+        try:
+            await ctx.author.send(**kwargs)
+            return
+        except discord.Forbidden:
+            pass
+    await ctx.send(ephemeral=True, **kwargs)
+
+# Autocomplete has to answer within Discord's 3 second deadline, so it never waits long on a state being read from disk.
+async def complete_staff_name(interaction, current):
+    if interaction.guild_id is None:
+        return []
+    try:
+        state = await asyncio.wait_for(asyncio.shield(get_state(interaction.guild_id)), AUTOCOMPLETE_WAIT)
+    except asyncio.TimeoutError:
+        return []
+    return [
+        app_commands.Choice(name=alias if alias == staff_name else f"{alias} ({staff_name})", value=staff_name)
+        for alias, staff_name in state.get_staff_index().complete(current)
+    ]
+
+async def auto_set_log_channels(guild, state=None):
+    accessible_channels = []
+    for channel in guild.text_channels:
+        permissions = channel.permissions_for(guild.me)
+        if permissions.read_messages and permissions.send_messages:
+            accessible_channels.append(channel)
+    if not accessible_channels:
+        print(f"Insufficient accessible text channels found for logging in {guild.name}!")
+        return
+    # A guild without stored data is only given a state once there is a channel to remember.
+    if state is None:
+        state = await get_state(guild.id)
+    if len(accessible_channels) >= 2:
+        await state.write(state.configure, log_channel_id=accessible_channels[0].id, bot_log_channel_id=accessible_channels[1].id)
+        embed = discord.Embed(
+            title=f"{EMOJI_SUCCESS} Log Channels Auto-Set",
+            description=f"Punishment log channel: {accessible_channels[0].mention}\nBot log channel: {accessible_channels[1].mention}",
+            color=discord.Color.green()
+        )
+        await accessible_channels[1].send(embed=embed)
+    else:
+        await state.write(state.configure, log_channel_id=accessible_channels[0].id, bot_log_channel_id=accessible_channels[0].id)
+        embed = discord.Embed(
+            title=f"{EMOJI_SUCCESS} Log Channel Auto-Set",
+            description=f"Using {accessible_channels[0].mention} for both punishment and bot logs",
+            color=discord.Color.green()
+        )
+        await accessible_channels[0].send(embed=embed)
+
+
+def resume_backfill(state):
+    log_channel = bot.get_channel(state.log_channel_id) if state.log_channel_id else None
+    resume_from = state.backfill_cursor or state.log_checkpoint
+    if log_channel and resume_from and (state.backfill_task is None or state.backfill_task.done()):
+        start_backfill(state, log_channel, discord.Object(id=resume_from)).add_done_callback(report_backfill_error)
+
+
+# Runs once, after login and before the gateway connects, so stored history is in memory before the first event arrives.
+@bot.event
+async def setup_hook():
+    # Client.run only stops cleanly on Ctrl+C. docker stop, systemd and the cluster launcher send SIGTERM, which has to close the bot
+    # the same way so the final save after bot.run writes whatever the flusher has not.
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.close()))
+    except NotImplementedError:
+        # Windows event loops take no signal handlers; there the process is stopped with Ctrl+C.
+        pass
+    find_stored_guilds()
+    started = time.perf_counter()
+    owned = [guild_id for guild_id in sorted(stored_guilds) if SHARD_IDS is None or (guild_id >> 22) % SHARD_COUNT in SHARD_IDS]
+    for guild_id in owned:
+        await get_state(guild_id)
+    print(f"Loaded {len(owned)} guilds in {time.perf_counter() - started:.2f}s")
+    # Slash commands are global; one worker registering them is enough.
+    if SYNC_APP_COMMANDS and (SHARD_IDS is None or 0 in SHARD_IDS):
+        try:
+            synced = await bot.tree.sync()
+            print(f"Synced {len(synced)} slash commands")
+        except discord.HTTPException as e:
+            print(f"Error syncing slash commands: {e}")
+
+
+# on_ready fires again after every reconnect; states already in memory are reused, not re-read.
 @bot.event
 async def on_ready():
-    global log_channel_id, bot_log_channel_id
+    global legacy_checked
     print(f'{bot.user} is ready!')
-   
-    load_data()
-   
-    if not log_channel_id or not bot_log_channel_id:
-        accessible_channels = []
-        for guild in bot.guilds:
-            for channel in guild.text_channels:
-                permissions = channel.permissions_for(guild.me)
-                if permissions.read_messages and permissions.send_messages:
-                    accessible_channels.append(channel)
-            if len(accessible_channels) >= 2:
-                log_channel_id = accessible_channels[0].id
-                bot_log_channel_id = accessible_channels[1].id
-                embed = discord.Embed(
-                    title=f"{EMOJI_SUCCESS} Log Channels Auto-Set",
-                    description=f"Punishment log channel: {accessible_channels[0].mention}\nBot log channel: {accessible_channels[1].mention}",
-                    color=discord.Color.green()
-                )
-                await accessible_channels[1].send(embed=embed)
-                save_data_to_file()
-                break
-            elif len(accessible_channels) == 1:
-                log_channel_id = accessible_channels[0].id
-                bot_log_channel_id = accessible_channels[0].id
-                embed = discord.Embed(
-                    title=f"{EMOJI_SUCCESS} Log Channel Auto-Set",
-                    description=f"Using {accessible_channels[0].mention} for both punishment and bot logs",
-                    color=discord.Color.green()
-                )
-                await accessible_channels[0].send(embed=embed)
-                save_data_to_file()
-                break
-            else:
-                print("Insufficient accessible text channels found for logging!")
-    
-    update_status.start()
 
-@bot.command(name='setstaffrole')
+    if not legacy_checked:
+        await claim_legacy_state()
+        legacy_checked = True
+    # Every stored guild is caught up; only states evicted for idleness have to be read back for that.
+    for guild in bot.guilds:
+        if guild.id not in stored_guilds:
+            # Joined while the bot was offline, so on_guild_join never ran for it.
+            await auto_set_log_channels(guild)
+            continue
+        state = await get_state(guild.id)
+        if not state.log_channel_id or not state.bot_log_channel_id:
+            await auto_set_log_channels(guild, state)
+        resume_backfill(state)
+
+    if not update_status.is_running():
+        update_status.start()
+    if not flush_state.is_running():
+        flush_state.start()
+    if not send_outbound.is_running():
+        send_outbound.start()
+    if not measure_loop_lag.is_running():
+        measure_loop_lag.start()
+    if not apply_retention.is_running():
+        apply_retention.start()
+    if METRICS_PORT and metrics_runner is None:
+        await start_metrics_server()
+    if not staff_update_workers:
+        staff_update_workers.extend(asyncio.create_task(staff_update_worker(queue)) for queue in staff_update_queues)
+
+@bot.event
+async def on_guild_join(guild):
+    state = await get_state(guild.id)
+    if not state.log_channel_id or not state.bot_log_channel_id:
+        await auto_set_log_channels(guild, state)
+
+@bot.hybrid_command(name='setstaffrole', description="Set the role that can access commands")
 @check_staff_role()
 async def set_staff_role(ctx, role_id: str):
-    global staff_role_id
+    state = await get_state(ctx.guild.id)
     try:
         role = await ctx.guild.fetch_role(int(role_id))
         if not role:
@@ -162,14 +2176,13 @@ async def set_staff_role(ctx, role_id: str):
             )
             await ctx.send(embed=embed)
             return
-        staff_role_id = role.id
+        await state.write(state.configure, staff_role_id=role.id)
         embed = discord.Embed(
             title=f"{EMOJI_ROLE} Staff Role Set",
             description=f"Staff role set to {role.mention}",
             color=discord.Color.green()
         )
         await ctx.send(embed=embed)
-        save_data_to_file()
     except (ValueError, discord.NotFound):
         embed = discord.Embed(
             title=f"{EMOJI_ERROR} Invalid Role ID",
@@ -185,10 +2198,10 @@ async def set_staff_role(ctx, role_id: str):
         )
         await ctx.send(embed=embed)
 
-@bot.command(name='setstaffupdate')
+@bot.hybrid_command(name='setstaffupdate', description="Set the channel for staff update messages")
 @check_staff_role()
 async def set_staff_update(ctx, channel_id: str):
-    global staff_update_channel_id
+    state = await get_state(ctx.guild.id)
     try:
         channel = await bot.fetch_channel(int(channel_id))
         if not isinstance(channel, discord.TextChannel):
@@ -210,14 +2223,13 @@ async def set_staff_update(ctx, channel_id: str):
             await ctx.send(embed=embed)
             return
         
-        staff_update_channel_id = channel.id
+        await state.write(state.configure, staff_update_channel_id=channel.id)
         embed = discord.Embed(
             title=f"{EMOJI_SUCCESS} Staff Update Channel Set",
             description=f"Staff update channel set to {channel.mention}",
             color=discord.Color.green()
         )
         await ctx.send(embed=embed)
-        save_data_to_file()
     except (ValueError, discord.NotFound):
         embed = discord.Embed(
             title=f"{EMOJI_ERROR} Invalid Channel ID",
@@ -233,39 +2245,56 @@ async def set_staff_update(ctx, channel_id: str):
         )
         await ctx.send(embed=embed)
 
-@bot.command(name='help')
+@bot.hybrid_command(name='help', description="Show every command and what it does")
 @check_staff_role()
 async def custom_help(ctx):
-    embed = discord.Embed(
-        title=f"{EMOJI_HELP} Command List",
-        description="Available commands and their functions:",
-        color=discord.Color.green()
-    )
     commands_list = [
         (".setstaffrole <role_id>", "Set the role that can access commands"),
         (".setchannellog <channel_id>", "Set the channel for reading punishment logs"),
         (".setbotlog <channel_id>", "Set the channel for bot's shard/punishment logs"),
         (".setstaffupdate <channel_id>", "Set the channel for staff update messages"),
-        (".setstaff <name>", "Add a staff member by name"),
-        (".removestaff <name>", "Remove a staff member by name"),
+        (".setstaff <name>", "Add a staff member by name, or bring back the one that name or alias belongs to"),
+        (".removestaff <name>", "Remove a staff member by name or alias"),
+        (".addalias <staff> <alias>", "Count punishment logs issued by another name (in any case) for a staff member"),
+        (".removealias <alias>", "Stop counting logs issued by an alias"),
+        (".renamestaff <staff> <new_name>", "Rename a staff member; the old name stays an alias"),
+        (".linkstaff <staff> <user>", "Link a staff member to a Discord user, so logs issued by their mention count"),
         (".stafflist", "Show all staff members and their shards (visible only to you)"),
         (".setweekly <date>", "Set weekly period start to date (YYYY-MM-DD)"),
         (".setstage <date>", "Set stage period start to date (YYYY-MM-DD)"),
         (".setbesttime <end_date>", "Set best time period to end on date (YYYY-MM-DD)"),
+        (".rules", "Show points per action type, bonus windows and rank modifiers"),
+        (".setpoints <Ban|Mute> <points> [preview]", "Set the points for an action type and recompute every staff member's shards"),
+        (".addbonus <from> <to> <multiplier> [preview]", "Multiply points for punishments between two dates (YYYY-MM-DD); windows may overlap"),
+        (".removebonus <number> [preview]", "Remove a bonus window by its number in .rules"),
+        (".setrank <staff> <rank|none> [preview]", "Put a staff member in a rank, or take them out of it"),
+        (".setrankmodifier <rank> <multiplier> [preview]", "Multiply points for every staff member in a rank"),
         (".unsetweekly", "Reset weekly period"),
         (".unsetstage", "Reset stage period"),
         (".unsetbesttime", "Reset best time period"),
         (".weeklyreport", "Show punishment stats for weekly period (visible only to you)"),
-        (".stagereport", "Show punishment stats for stage period (visible only to you)")
+        (".stagereport", "Show punishment stats for stage period (visible only to you)"),
+        (".report <from> <to> [staff]", "Show punishment stats between two dates (YYYY-MM-DD), optionally for one staff member (visible only to you)"),
+        (".export <from> <to> [csv|jsonl]", "Download punishments between two dates (YYYY-MM-DD) as gzipped files, split to fit the upload limit"),
+        (".leaderboard [all|weekly|stage] [page|staff]", "Rank staff by shards for all time or a period, with page buttons (visible only to you)"),
+        (".backfill [date]", "Re-read the punishment log channel from a date (YYYY-MM-DD) or the last checkpoint"),
+        (".queue", "Show how many bot log messages are waiting to be posted (visible only to you)"),
+        (".cachestats", "Show member lookup cache hits and REST calls saved (visible only to you)"),
+        (".stats", "Show handler, parser, flush and send latencies plus gateway and event loop lag (visible only to you)")
     ]
-    for cmd, desc in commands_list:
-        embed.add_field(name=cmd, value=desc, inline=False)
-    await ctx.send(embed=embed, ephemeral=True)
+    # More commands than one embed holds fields for, so the list is paged like the reports.
+    pages = render_pages(
+        f"{EMOJI_HELP} Command List",
+        "Available commands and their functions. Each one also works as a slash command; replies marked visible only to you arrive by DM when typed with the . prefix.",
+        [(cmd, desc, False) for cmd, desc in commands_list],
+        None
+    )
+    await send_pages(ctx, pages)
 
-@bot.command(name='setchannellog')
+@bot.hybrid_command(name='setchannellog', description="Set the channel for reading punishment logs")
 @check_staff_role()
 async def set_channel_log(ctx, channel_id: str):
-    global log_channel_id
+    state = await get_state(ctx.guild.id)
     try:
         channel = await bot.fetch_channel(int(channel_id))
         if not isinstance(channel, discord.TextChannel):
@@ -287,14 +2316,13 @@ async def set_channel_log(ctx, channel_id: str):
             await ctx.send(embed=embed)
             return
         
-        log_channel_id = channel.id
+        await state.write(state.configure, log_channel_id=channel.id)
         embed = discord.Embed(
             title=f"{EMOJI_SUCCESS} Log Channel Set",
             description=f"Punishment log channel set to {channel.mention}",
             color=discord.Color.green()
         )
         await ctx.send(embed=embed)
-        save_data_to_file()
     except (ValueError, discord.NotFound):
         embed = discord.Embed(
             title=f"{EMOJI_ERROR} Invalid Channel ID",
@@ -308,102 +2336,395 @@ async def set_channel_log(ctx, channel_id: str):
             description="Bot lacks permission to access that channel.",
             color=discord.Color.red()
         )
-        await ctx.send(embed=embed)
+        await ctx.send(embed=embed)
+
+@bot.hybrid_command(name='setbotlog', description="Set the channel for the bot's shard/punishment logs")
+@check_staff_role()
+async def set_bot_log(ctx, channel_id: str):
+    state = await get_state(ctx.guild.id)
+    try:
+        channel = await bot.fetch_channel(int(channel_id))
+        if not isinstance(channel, discord.TextChannel):
+            embed = discord.Embed(
+                title=f"{EMOJI_ERROR} Invalid Channel",
+                description="The provided ID does not belong to a text channel.",
+                color=discord.Color.red()
+            )
+            await ctx.send(embed=embed)
+            return
+        
+        permissions = channel.permissions_for(ctx.guild.me)
+        if not (permissions.read_messages and permissions.send_messages):
+            embed = discord.Embed(
+                title=f"{EMOJI_ERROR} Permission Error",
+                description="Bot lacks permissions to read or send messages in that channel.",
+                color=discord.Color.red()
+            )
+            await ctx.send(embed=embed)
+            return
+        
+        await state.write(state.configure, bot_log_channel_id=channel.id)
+        embed = discord.Embed(
+            title=f"{EMOJI_SUCCESS} Bot Log Channel Set",
+            description=f"Bot log channel set to {channel.mention}",
+            color=discord.Color.green()
+        )
+        await ctx.send(embed=embed)
+    except (ValueError, discord.NotFound):
+        embed = discord.Embed(
+            title=f"{EMOJI_ERROR} Invalid Channel ID",
+            description="Please provide a valid channel ID.",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
+    except discord.Forbidden:
+        embed = discord.Embed(
+            title=f"{EMOJI_ERROR} Permission Error",
+            description="Bot lacks permission to access that channel.",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
+
+@bot.hybrid_command(name='setstaff', description="Add a staff member by name, or bring back one with that name or alias")
+@check_staff_role()
+async def set_staff(ctx, staff_name: str):
+    state = await get_state(ctx.guild.id)
+    staff_id = await state.write(state.add_staff, staff_name)
+    embed = discord.Embed(
+        title=f"{EMOJI_SUCCESS} Staff Added",
+        description=f"{state.staff_name(staff_id)} has been added as staff.",
+        color=discord.Color.green()
+    )
+    await ctx.send(embed=embed)
+
+async def send_staff_error(ctx, description):
+    embed = discord.Embed(
+        title=f"{EMOJI_ERROR} Error",
+        description=description,
+        color=discord.Color.red()
+    )
+    await ctx.send(embed=embed)
+
+@bot.hybrid_command(name='removestaff', description="Remove a staff member by name or alias")
+@check_staff_role()
+async def remove_staff(ctx, staff_name: str):
+    state = await get_state(ctx.guild.id)
+    staff_id = state.resolve_staff(staff_name)
+    if staff_id not in state.staff_list:
+        await send_staff_error(ctx, f"{staff_name} is not a staff member.")
+        return
+    await state.write(state.remove_staff, staff_id)
+    embed = discord.Embed(
+        title=f"{EMOJI_SUCCESS} Staff Removed",
+        description=f"{state.staff_name(staff_id)} has been removed from staff.",
+        color=discord.Color.green()
+    )
+    await ctx.send(embed=embed)
+
+remove_staff.autocomplete('staff_name')(complete_staff_name)
+
+@bot.hybrid_command(name='addalias', description="Count logs issued under another name for a staff member")
+@check_staff_role()
+async def add_alias(ctx, staff_name: str, alias: str):
+    state = await get_state(ctx.guild.id)
+    staff_id = state.resolve_staff(staff_name)
+    if staff_id is None:
+        await send_staff_error(ctx, f"{staff_name} is not a staff member.")
+        return
+    owner = await state.write(state.add_staff_alias, staff_id, alias)
+    if owner is not None:
+        await send_staff_error(ctx, f"{alias} already leads to {state.staff_name(owner)}.")
+        return
+    embed = discord.Embed(
+        title=f"{EMOJI_SUCCESS} Alias Added",
+        description=f"Logs issued by {alias} now count for {state.staff_name(staff_id)}.",
+        color=discord.Color.green()
+    )
+    await ctx.send(embed=embed)
+
+add_alias.autocomplete('staff_name')(complete_staff_name)
+
+@bot.hybrid_command(name='removealias', description="Stop counting logs issued under an alias")
+@check_staff_role()
+async def remove_alias(ctx, alias: str):
+    state = await get_state(ctx.guild.id)
+    staff_id = state.resolve_staff(alias)
+    if staff_id is None or normalize_staff_name(alias) == normalize_staff_name(state.staff_name(staff_id)):
+        await send_staff_error(ctx, f"{alias} is not an alias. A staff member's own name can be changed with .renamestaff.")
+        return
+    await state.write(state.remove_staff_alias, staff_id, alias)
+    embed = discord.Embed(
+        title=f"{EMOJI_SUCCESS} Alias Removed",
+        description=f"Logs issued by {alias} no longer count for {state.staff_name(staff_id)}.",
+        color=discord.Color.green()
+    )
+    await ctx.send(embed=embed)
+
+@bot.hybrid_command(name='renamestaff', description="Rename a staff member; the old name keeps counting as an alias")
+@check_staff_role()
+async def rename_staff(ctx, staff_name: str, new_name: str):
+    state = await get_state(ctx.guild.id)
+    staff_id = state.resolve_staff(staff_name)
+    if staff_id is None:
+        await send_staff_error(ctx, f"{staff_name} is not a staff member.")
+        return
+    old_name = state.staff_name(staff_id)
+    owner = await state.write(state.rename_staff, staff_id, new_name)
+    if owner is not None:
+        await send_staff_error(ctx, f"{new_name} already leads to {state.staff_name(owner)}.")
+        return
+    embed = discord.Embed(
+        title=f"{EMOJI_SUCCESS} Staff Renamed",
+        description=f"{old_name} is now {new_name}; logs issued by {old_name} still count.",
+        color=discord.Color.green()
+    )
+    await ctx.send(embed=embed)
+
+rename_staff.autocomplete('staff_name')(complete_staff_name)
+
+@bot.hybrid_command(name='linkstaff', description="Link a staff member to a Discord user, so logs mentioning them count")
+@check_staff_role()
+async def link_staff(ctx, staff_name: str, user: discord.User):
+    state = await get_state(ctx.guild.id)
+    staff_id = state.resolve_staff(staff_name)
+    if staff_id is None:
+        await send_staff_error(ctx, f"{staff_name} is not a staff member.")
+        return
+    await state.write(state.link_staff_user, staff_id, user.id)
+    embed = discord.Embed(
+        title=f"{EMOJI_SUCCESS} Staff Linked",
+        description=f"{state.staff_name(staff_id)} is linked to {user.mention}.",
+        color=discord.Color.green()
+    )
+    await ctx.send(embed=embed)
+
+link_staff.autocomplete('staff_name')(complete_staff_name)
+
+def render_pages(title, description, fields, empty_field):
+    chunks = [fields[i:i + EMBED_FIELD_LIMIT] for i in range(0, len(fields), EMBED_FIELD_LIMIT)] or [[empty_field]]
+    pages = []
+    for number, chunk in enumerate(chunks, 1):
+        embed = discord.Embed(
+            title=title,
+            description=description,
+            color=discord.Color.green()
+        )
+        for name, value, inline in chunk:
+            embed.add_field(name=name, value=value, inline=inline)
+        if len(chunks) > 1:
+            embed.set_footer(text=f"Page {number}/{len(chunks)}")
+        pages.append(embed)
+    return pages
+
+
+class PagedView(discord.ui.View):
+    def __init__(self, author_id, page, pages):
+        super().__init__(timeout=PAGE_VIEW_TIMEOUT)
+        self.author_id = author_id
+        self.page = page
+        self.update_buttons(pages)
+
+    def update_buttons(self, pages):
+        self.previous_page.disabled = self.page <= 1
+        self.next_page.disabled = self.page >= pages
+
+    async def interaction_check(self, interaction):
+        return interaction.user.id == self.author_id
+
+    async def turn(self, interaction, step):
+        embed, self.page, pages = await self.render(self.page + step)
+        if embed is None:
+            await interaction.response.edit_message(view=None)
+            return
+        self.update_buttons(pages)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.turn(interaction, -1)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.turn(interaction, 1)
+
+
+class EmbedPagesView(PagedView):
+    def __init__(self, author_id, pages):
+        self.pages = pages
+        super().__init__(author_id, 1, len(pages))
+
+    async def render(self, page):
+        page = min(max(page, 1), len(self.pages))
+        return self.pages[page - 1], page, len(self.pages)
+
+
+async def send_pages(ctx, pages):
+    view = EmbedPagesView(ctx.author.id, pages) if len(pages) > 1 else None
+    await send_private(ctx, embed=pages[0], view=view)
+
+@bot.hybrid_command(name='stafflist', description="Show all staff members and their shards")
+@check_staff_role()
+async def staff_list_command(ctx):
+    state = await get_state(ctx.guild.id)
+    pages = state.cached_render(('stafflist',))
+    if pages is None:
+        generation = state.render_generation
+        if STORAGE_BACKEND == 'sqlite':
+            totals = await state.query_db(state.db_staff_totals)
+        else:
+            totals = [(staff_id, state.staff_shards.get(staff_id, 0)) for staff_id in state.staff_list]
+        pages = render_pages(
+            f"{EMOJI_STAFF} Staff List",
+            "List of all staff members and their total shards:",
+            [(staff_name, f"{shards} shards", True) for staff_name, shards in sorted((state.staff_name(staff_id), shards) for staff_id, shards in totals)],
+            ("No Staff", "No staff members registered.", False)
+        )
+        state.store_render(('stafflist',), None, None, pages, generation)
+    await send_pages(ctx, pages)
+
+def leaderboard_embed(state, board, period, page, highlight=None):
+    pages = max(1, -(-len(board) // LEADERBOARD_PAGE_SIZE))
+    page = min(max(page, 1), pages)
+    lines = []
+    for rank, staff_id, shards in board.page((page - 1) * LEADERBOARD_PAGE_SIZE, LEADERBOARD_PAGE_SIZE):
+        line = f"**#{rank}** {state.staff_name(staff_id)}: {shards} shards"
+        lines.append(f"__{line}__" if staff_id == highlight else line)
+    embed = discord.Embed(
+        title=f"{EMOJI_REPORT} {period.capitalize()} Leaderboard",
+        description='\n'.join(lines) or "No staff members registered.",
+        color=discord.Color.green()
+    )
+    embed.set_footer(text=f"Page {page}/{pages} · {len(board)} staff")
+    return embed, page, pages
+
 
-@bot.command(name='setbotlog')
+class LeaderboardView(PagedView):
+    def __init__(self, author_id, guild_id, period, page, pages, highlight):
+        self.guild_id = guild_id
+        self.period = period
+        self.highlight = highlight
+        super().__init__(author_id, page, pages)
+
+    async def render(self, page):
+        state = await get_state(self.guild_id)
+        board = await state.leaderboard(self.period)
+        if board is None:
+            return None, page, 0
+        # Re-rendered from the live board, so every page reflects punishments logged since the command ran.
+        return leaderboard_embed(state, board, self.period, page, self.highlight)
+
+
+@bot.hybrid_command(name='leaderboard', description="Rank staff by shards for all time or a period")
 @check_staff_role()
-async def set_bot_log(ctx, channel_id: str):
-    global bot_log_channel_id
-    try:
-        channel = await bot.fetch_channel(int(channel_id))
-        if not isinstance(channel, discord.TextChannel):
-            embed = discord.Embed(
-                title=f"{EMOJI_ERROR} Invalid Channel",
-                description="The provided ID does not belong to a text channel.",
-                color=discord.Color.red()
-            )
-            await ctx.send(embed=embed)
-            return
-        
-        permissions = channel.permissions_for(ctx.guild.me)
-        if not (permissions.read_messages and permissions.send_messages):
-            embed = discord.Embed(
-                title=f"{EMOJI_ERROR} Permission Error",
-                description="Bot lacks permissions to read or send messages in that channel.",
-                color=discord.Color.red()
-            )
-            await ctx.send(embed=embed)
-            return
-        
-        bot_log_channel_id = channel.id
+async def leaderboard(ctx, period: str = 'all', page: str = '1'):
+    state = await get_state(ctx.guild.id)
+    period = period.lower()
+    if period not in LEADERBOARD_PERIODS:
         embed = discord.Embed(
-            title=f"{EMOJI_SUCCESS} Bot Log Channel Set",
-            description=f"Bot log channel set to {channel.mention}",
-            color=discord.Color.green()
+            title=f"{EMOJI_ERROR} Invalid Period",
+            description=f"Period must be one of: {', '.join(LEADERBOARD_PERIODS)}.",
+            color=discord.Color.red()
         )
-        await ctx.send(embed=embed)
-        save_data_to_file()
-    except (ValueError, discord.NotFound):
+        await send_private(ctx, embed=embed)
+        return
+    board = await state.leaderboard(period)
+    if board is None:
         embed = discord.Embed(
-            title=f"{EMOJI_ERROR} Invalid Channel ID",
-            description="Please provide a valid channel ID.",
+            title=f"{EMOJI_ERROR} No {period.capitalize()} Period",
+            description=f"{period.capitalize()} period is not set. Use .set{period} to set it.",
             color=discord.Color.red()
         )
-        await ctx.send(embed=embed)
-    except discord.Forbidden:
+        await send_private(ctx, embed=embed)
+        return
+
+    # The page argument may also be a staff name, which opens the page holding that member's rank.
+    highlight = None
+    staff_id = state.resolve_staff(page)
+    if page.isdigit():
+        page_number = int(page)
+    elif board.rank(staff_id):
+        highlight = staff_id
+        page_number = (board.rank(staff_id) - 1) // LEADERBOARD_PAGE_SIZE + 1
+    else:
         embed = discord.Embed(
-            title=f"{EMOJI_ERROR} Permission Error",
-            description="Bot lacks permission to access that channel.",
+            title=f"{EMOJI_ERROR} Unknown Staff",
+            description=f"{page} is not a page number or a staff member.",
             color=discord.Color.red()
         )
-        await ctx.send(embed=embed)
+        await send_private(ctx, embed=embed)
+        return
+
+    embed, page_number, pages = leaderboard_embed(state, board, period, page_number, highlight)
+    view = LeaderboardView(ctx.author.id, ctx.guild.id, period, page_number, pages, highlight) if pages > 1 else None
+    await send_private(ctx, embed=embed, view=view)
 
-@bot.command(name='setstaff')
+leaderboard.autocomplete('page')(complete_staff_name)
+
+@bot.hybrid_command(name='queue', description="Show how many bot log messages are waiting to be posted")
 @check_staff_role()
-async def set_staff(ctx, staff_name: str):
-    staff_list.add(staff_name)
+async def queue_status(ctx):
     embed = discord.Embed(
-        title=f"{EMOJI_SUCCESS} Staff Added",
-        description=f"{staff_name} has been added as staff.",
+        title=f"{EMOJI_TIME} Bot Log Queue",
+        description=f"{outbound_depth()} punishment logs waiting to be posted.\nLast batch was posted {outbound_last_lag:.1f}s after it was queued.",
         color=discord.Color.green()
     )
-    await ctx.send(embed=embed)
-    save_data_to_file()
+    await send_private(ctx, embed=embed)
 
-@bot.command(name='removestaff')
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started = time.perf_counter()
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    observe('command_seconds', time.perf_counter() - ctx.started, command=ctx.command.name)
+    count('commands_total', command=ctx.command.name, status='error' if ctx.command_failed else 'ok')
+
+def format_latency(seconds):
+    if seconds is None:
+        return "n/a"
+    return f"{seconds * 1000000:.0f} µs" if seconds < 0.001 else f"{seconds * 1000:.1f} ms"
+
+@bot.hybrid_command(name='stats', description="Show handler, parser, flush and send latencies plus gateway and event loop lag")
 @check_staff_role()
-async def remove_staff(ctx, staff_name: str):
-    if staff_name in staff_list:
-        staff_list.remove(staff_name)
-        embed = discord.Embed(
-            title=f"{EMOJI_SUCCESS} Staff Removed",
-            description=f"{staff_name} has been removed from staff.",
-            color=discord.Color.green()
-        )
-    else:
-        embed = discord.Embed(
-            title=f"{EMOJI_ERROR} Error",
-            description=f"{staff_name} is not a staff member.",
-            color=discord.Color.red()
-        )
-    await ctx.send(embed=embed)
-    save_data_to_file()
+async def stats(ctx):
+    embed = discord.Embed(
+        title=f"{EMOJI_REPORT} Bot Stats",
+        description=f"Serving {len(guild_states)} loaded guilds. Latencies are p50 / p99 bucket bounds.",
+        color=discord.Color.green()
+    )
+    for label, name, labels in [
+        ("Log Message Handler", 'handler_seconds', {'handler': 'message'}),
+        ("Parser", 'parse_seconds', {}),
+        ("Persistence Flush", 'persist_seconds', {'kind': 'flush'}),
+        ("Bot Log Send", 'outbound_send_seconds', {}),
+        ("Staff Update", 'handler_seconds', {'handler': 'staff_update'}),
+    ]:
+        embed.add_field(name=label, value=f"{format_latency(quantile(name, 0.5, **labels))} / {format_latency(quantile(name, 0.99, **labels))}", inline=True)
+    ingested = sum(value for (name, _), value in metrics_counters.items() if name == 'punishments_ingested_total')
+    embed.add_field(name="Messages Seen", value=metrics_counters.get(('events_total', (('event', 'message'),)), 0), inline=True)
+    embed.add_field(name="Punishments Logged", value=ingested, inline=True)
+    embed.add_field(name="Gateway Latency", value=format_latency(None if math.isnan(bot.latency) else bot.latency), inline=True)
+    embed.add_field(name="Event Loop Lag", value=format_latency(metrics_gauges.get('event_loop_lag_last_seconds')), inline=True)
+    embed.add_field(name="Log Channel Lag", value=format_latency(metrics_gauges.get('log_delay_last_seconds')), inline=True)
+    embed.add_field(name="Bot Log Queue", value=f"{outbound_depth()} waiting", inline=True)
+    await send_private(ctx, embed=embed)
 
-@bot.command(name='stafflist')
+@bot.hybrid_command(name='cachestats', description="Show member lookup cache hits and REST calls saved")
 @check_staff_role()
-async def staff_list_command(ctx):
+async def cache_stats(ctx):
+    lookups = sum(member_cache_stats.values())
+    saved = lookups - member_cache_stats['fetches']
     embed = discord.Embed(
-        title=f"{EMOJI_STAFF} Staff List",
-        description="List of all staff members and their total shards:",
+        title=f"{EMOJI_STAFF} Member Cache",
+        description=f"{saved} of {lookups} member lookups avoided a REST call.",
         color=discord.Color.green()
     )
-    if staff_list:
-        for staff_name in sorted(staff_list):
-            shards = staff_shards.get(staff_name, 0)
-            embed.add_field(name=staff_name, value=f"{shards} shards", inline=True)
-    else:
-        embed.add_field(name="No Staff", value="No staff members registered.", inline=False)
-    await ctx.send(embed=embed, ephemeral=True)
+    embed.add_field(name="Gateway Hits", value=member_cache_stats['gateway_hits'], inline=True)
+    embed.add_field(name="Cache Hits", value=member_cache_stats['cache_hits'], inline=True)
+    embed.add_field(name="Not Found Hits", value=member_cache_stats['not_found_hits'], inline=True)
+    embed.add_field(name="REST Fetches", value=member_cache_stats['fetches'], inline=True)
+    embed.add_field(name="Cached Entries", value=len(member_cache), inline=True)
+    await send_private(ctx, embed=embed)
 
 def parse_date(date_str):
     try:
@@ -412,16 +2733,17 @@ def parse_date(date_str):
     except ValueError:
         return None
 
-@bot.command(name='setweekly')
+@bot.hybrid_command(name='setweekly', description="Set weekly period start to a date (YYYY-MM-DD)")
 @check_staff_role()
+@app_commands.rename(date_str='date')
 async def set_weekly(ctx, date_str: str):
-    global weekly_start
+    state = await get_state(ctx.guild.id)
     date = parse_date(date_str)
     if date and date <= datetime.now():
-        weekly_start = date
+        await state.write(state.configure, weekly_start=date)
         embed = discord.Embed(
             title=f"{EMOJI_TIME} Weekly Period Set",
-            description=f"Weekly period starts on {weekly_start.strftime('%Y-%m-%d')}",
+            description=f"Weekly period starts on {state.weekly_start.strftime('%Y-%m-%d')}",
             color=discord.Color.green()
         )
     else:
@@ -431,18 +2753,18 @@ async def set_weekly(ctx, date_str: str):
             color=discord.Color.red()
         )
     await ctx.send(embed=embed)
-    save_data_to_file()
 
-@bot.command(name='setstage')
+@bot.hybrid_command(name='setstage', description="Set stage period start to a date (YYYY-MM-DD)")
 @check_staff_role()
+@app_commands.rename(date_str='date')
 async def set_stage(ctx, date_str: str):
-    global stage_start
+    state = await get_state(ctx.guild.id)
     date = parse_date(date_str)
     if date and date <= datetime.now():
-        stage_start = date
+        await state.write(state.configure, stage_start=date)
         embed = discord.Embed(
             title=f"{EMOJI_TIME} Stage Period Set",
-            description=f"Stage period starts on {stage_start.strftime('%Y-%m-%d')}",
+            description=f"Stage period starts on {state.stage_start.strftime('%Y-%m-%d')}",
             color=discord.Color.green()
         )
     else:
@@ -452,20 +2774,19 @@ async def set_stage(ctx, date_str: str):
             color=discord.Color.red()
         )
     await ctx.send(embed=embed)
-    save_data_to_file()
 
-@bot.command(name='setbesttime')
+@bot.hybrid_command(name='setbesttime', description="Set best time period to end on a date (YYYY-MM-DD)")
 @check_staff_role()
+@app_commands.rename(end_date_str='end_date')
 async def set_best_time(ctx, end_date_str: str):
-    global best_time_start, best_time_end
+    state = await get_state(ctx.guild.id)
     end_date = parse_date(end_date_str)
     now = datetime.now()
     if end_date and end_date > now:
-        best_time_start = now
-        best_time_end = end_date
+        await state.write(state.change_best_time, now, end_date)
         embed = discord.Embed(
             title=f"{EMOJI_TIME} Best Time Set",
-            description=f"Best time starts now and ends on {best_time_end.strftime('%Y-%m-%d')}",
+            description=f"Best time starts now and ends on {state.best_time_end.strftime('%Y-%m-%d')}",
             color=discord.Color.green()
         )
     else:
@@ -475,136 +2796,365 @@ async def set_best_time(ctx, end_date_str: str):
             color=discord.Color.red()
         )
     await ctx.send(embed=embed)
-    save_data_to_file()
 
-@bot.command(name='unsetweekly')
+@bot.hybrid_command(name='unsetweekly', description="Reset weekly period")
 @check_staff_role()
 async def unset_weekly(ctx):
-    global weekly_start
-    weekly_start = None
+    state = await get_state(ctx.guild.id)
+    await state.write(state.configure, weekly_start=None)
     embed = discord.Embed(
         title=f"{EMOJI_SUCCESS} Weekly Period Unset",
         description="Weekly period has been reset.",
         color=discord.Color.green()
     )
     await ctx.send(embed=embed)
-    save_data_to_file()
 
-@bot.command(name='unsetstage')
+@bot.hybrid_command(name='unsetstage', description="Reset stage period")
 @check_staff_role()
 async def unset_stage(ctx):
-    global stage_start
-    stage_start = None
+    state = await get_state(ctx.guild.id)
+    await state.write(state.configure, stage_start=None)
     embed = discord.Embed(
         title=f"{EMOJI_SUCCESS} Stage Period Unset",
         description="Stage period has been reset.",
         color=discord.Color.green()
     )
     await ctx.send(embed=embed)
-    save_data_to_file()
 
-@bot.command(name='unsetbesttime')
+@bot.hybrid_command(name='unsetbesttime', description="Reset best time period")
 @check_staff_role()
 async def unset_best_time(ctx):
-    global best_time_start, best_time_end
-    best_time_start = None
-    best_time_end = None
+    state = await get_state(ctx.guild.id)
+    await state.write(state.change_best_time, None, None)
     embed = discord.Embed(
         title=f"{EMOJI_SUCCESS} Best Time Unset",
-        description="Best time period has been reset.",
+        description="Best time period has been reset. Punishments it already doubled keep their bonus, listed in .rules as a bonus window.",
         color=discord.Color.green()
     )
     await ctx.send(embed=embed)
-    save_data_to_file()
 
-@bot.command(name='weeklyreport')
+async def send_rule_error(ctx, description):
+    embed = discord.Embed(
+        title=f"{EMOJI_ERROR} Invalid Rule",
+        description=description,
+        color=discord.Color.red()
+    )
+    await ctx.send(embed=embed)
+
+# Every rule command takes a trailing "preview" to see each staff member's shard change without saving anything.
+# update takes the rule's current value and returns the new one, or raises ValueError with the message to show.
+async def change_rules(ctx, state, key, update, mode):
+    await ctx.defer(ephemeral=True)
+    try:
+        if mode == 'preview':
+            value = update(getattr(state, key))
+        else:
+            changes = await state.write(state.change_rule, key, update)
+    except ValueError as e:
+        await send_rule_error(ctx, str(e))
+        return
+    if mode == 'preview':
+        changes = await state.recompute_shards(state.scoring_rules(**{key: value}))
+        title = f"{EMOJI_REPORT} Rule Change Preview"
+        description = "Nothing has been saved. Run the command again without preview to apply it."
+    else:
+        title = f"{EMOJI_SUCCESS} Rules Updated"
+        description = f"Shards were recomputed over the whole history; {len(changes)} staff member(s) changed."
+    fields = [
+        (staff_name, f"{old} → {new} ({new - old:+})", True)
+        for staff_name, (old, new) in sorted(((state.staff_name(staff_id), change) for staff_id, change in changes.items()),
+                                             key=lambda item: (-abs(item[1][1] - item[1][0]), item[0]))
+    ]
+    await send_pages(ctx, render_pages(title, description, fields, ("No Changes", "No staff member's shards change.", False)))
+
+@bot.hybrid_command(name='rules', description="Show points per action type, bonus windows and rank modifiers")
+@check_staff_role()
+async def show_rules(ctx):
+    state = await get_state(ctx.guild.id)
+    rules = state.get_rules()
+    # Window ends are exclusive; a best-time window kept on when it was replaced can end part way through a day.
+    windows = [f"{number}. {start[:10]} to {(datetime.fromisoformat(end) - MICROSECOND).strftime('%Y-%m-%d')}: x{multiplier:g}"
+               for number, (start, end, multiplier) in enumerate(state.bonus_windows or [], 1)]
+    if state.best_time_start and state.best_time_end:
+        windows.append(f"Best time until {state.best_time_end.strftime('%Y-%m-%d')}: x{BEST_TIME_MULTIPLIER}")
+    ranks = {}
+    for staff_id, rank in rules.staff_ranks.items():
+        ranks.setdefault(rank, []).append(state.staff_name(staff_id))
+    embed = discord.Embed(
+        title=f"{EMOJI_REPORT} Scoring Rules",
+        description="Points per punishment, multiplied by every bonus window it falls in and by its staff member's rank modifier.",
+        color=discord.Color.green()
+    )
+    embed.add_field(name="Points", value="\n".join(f"{action_type}: {rules.point_table[action_type]}" for action_type in ACTION_TYPES), inline=False)
+    embed.add_field(name="Bonus Windows", value="\n".join(windows) or "None", inline=False)
+    embed.add_field(name="Ranks", value="\n".join(
+        f"{rank} (x{rules.rank_modifiers.get(rank, 1.0):g}): {', '.join(sorted(names))}" for rank, names in sorted(ranks.items())
+    ) or "None", inline=False)
+    await send_private(ctx, embed=embed)
+
+@bot.hybrid_command(name='setpoints', description="Set the points for an action type and recompute every staff member's shards")
+@check_staff_role()
+async def set_points(ctx, action_type: str, points: int, mode: Literal['preview'] = None):
+    state = await get_state(ctx.guild.id)
+    action_type = action_type.capitalize()
+    if action_type not in ACTION_TYPES or points < 0:
+        await send_rule_error(ctx, f"Give an action type ({' or '.join(ACTION_TYPES)}) and a points value of 0 or more.")
+        return
+    await change_rules(ctx, state, 'point_table', lambda point_table: dict(point_table or {}, **{action_type: points}), mode)
+
+@bot.hybrid_command(name='addbonus', description="Multiply points for punishments between two dates (YYYY-MM-DD)")
+@check_staff_role()
+@app_commands.rename(from_str='from', to_str='to')
+async def add_bonus(ctx, from_str: str, to_str: str, multiplier: float, mode: Literal['preview'] = None):
+    state = await get_state(ctx.guild.id)
+    start = parse_date(from_str)
+    end = parse_date(to_str)
+    if not start or not end or end < start or multiplier <= 0:
+        await send_rule_error(ctx, "Give two valid dates (YYYY-MM-DD), the first not after the second, and a multiplier above 0.")
+        return
+    window = [start.isoformat(), (end + timedelta(days=1)).isoformat(), multiplier]
+    await change_rules(ctx, state, 'bonus_windows', lambda windows: list(windows or []) + [window], mode)
+
+@bot.hybrid_command(name='removebonus', description="Remove a bonus window by its number in rules")
+@check_staff_role()
+async def remove_bonus(ctx, number: int, mode: Literal['preview'] = None):
+    state = await get_state(ctx.guild.id)
+    def remove(windows):
+        windows = list(windows or [])
+        if not 1 <= number <= len(windows):
+            raise ValueError("Give the number of a bonus window as listed by .rules.")
+        del windows[number - 1]
+        return windows
+    await change_rules(ctx, state, 'bonus_windows', remove, mode)
+
+@bot.hybrid_command(name='setrank', description="Put a staff member in a rank, or take them out of it with none")
+@check_staff_role()
+async def set_rank(ctx, staff_name: str, rank: str, mode: Literal['preview'] = None):
+    state = await get_state(ctx.guild.id)
+    staff_id = state.resolve_staff(staff_name)
+    if staff_id is None:
+        await send_rule_error(ctx, f"{staff_name} is not a staff member.")
+        return
+    def assign(staff_ranks):
+        ranks = dict(staff_ranks or [])
+        if rank.lower() == 'none':
+            ranks.pop(staff_id, None)
+        else:
+            ranks[staff_id] = rank
+        return sorted(ranks.items())
+    await change_rules(ctx, state, 'staff_ranks', assign, mode)
+
+set_rank.autocomplete('staff_name')(complete_staff_name)
+
+@bot.hybrid_command(name='setrankmodifier', description="Multiply points for every staff member in a rank")
+@check_staff_role()
+async def set_rank_modifier(ctx, rank: str, multiplier: float, mode: Literal['preview'] = None):
+    state = await get_state(ctx.guild.id)
+    if multiplier < 0:
+        await send_rule_error(ctx, "Give a rank and a multiplier of 0 or more.")
+        return
+    await change_rules(ctx, state, 'rank_modifiers', lambda rank_modifiers: dict(rank_modifiers or {}, **{rank: multiplier}), mode)
+
+def render_report(state, title, description, report):
+    return render_pages(
+        title,
+        description,
+        [
+            (staff_name, f"Bans: {counts['Ban']}\nMutes: {counts['Mute']}\nShards: {counts['Shards']}", True)
+            for staff_name, counts in sorted((state.staff_name(staff_id), counts) for staff_id, counts in report.items())
+        ],
+        ("No Data", "No punishments recorded.", False)
+    )
+
+async def send_report(ctx, state, key, start, end, title, description, staff=None):
+    pages = state.cached_render(key)
+    if pages is None:
+        # A cold report can outlast the interaction deadline, so the reply is acknowledged before it is built.
+        await ctx.defer(ephemeral=True)
+        generation = state.render_generation
+        report = await state.build_report(start, end, staff)
+        pages = state.store_render(key, start, end, render_report(state, title, description, report), generation)
+    await send_pages(ctx, pages)
+
+@bot.hybrid_command(name='report', description="Show punishment stats between two dates (YYYY-MM-DD), optionally for one staff member")
+@check_staff_role()
+@app_commands.rename(from_str='from', to_str='to')
+async def range_report(ctx, from_str: str, to_str: str, staff_name: str = None):
+    start = parse_date(from_str)
+    end = parse_date(to_str)
+    if not start or not end or end < start:
+        embed = discord.Embed(
+            title=f"{EMOJI_ERROR} Invalid Date Range",
+            description="Please provide two valid dates (YYYY-MM-DD), the first not after the second.",
+            color=discord.Color.red()
+        )
+        await send_private(ctx, embed=embed)
+        return
+
+    state = await get_state(ctx.guild.id)
+    staff_id = None
+    description = f"From {start.strftime('%Y-%m-%d')} to {end.strftime('%Y-%m-%d')}"
+    if staff_name:
+        staff_id = state.resolve_staff(staff_name)
+        if staff_id is None:
+            await send_private(ctx, embed=discord.Embed(
+                title=f"{EMOJI_ERROR} Error",
+                description=f"{staff_name} is not a staff member.",
+                color=discord.Color.red()
+            ))
+            return
+        description += f" for {state.staff_name(staff_id)}"
+    end += timedelta(days=1)
+    await send_report(ctx, state, ('report', start, end, staff_id), start, end, f"{EMOJI_REPORT} Punishment Report", description, staff_id)
+
+range_report.autocomplete('staff_name')(complete_staff_name)
+
+@bot.hybrid_command(name='weeklyreport', description="Show punishment stats for the weekly period")
 @check_staff_role()
 async def weekly_report(ctx):
-    if not weekly_start:
+    state = await get_state(ctx.guild.id)
+    if not state.weekly_start:
         embed = discord.Embed(
             title=f"{EMOJI_ERROR} No Weekly Period",
             description="Weekly period is not set. Use .setweekly to set it.",
             color=discord.Color.red()
         )
-        await ctx.send(embed=embed, ephemeral=True)
+        await send_private(ctx, embed=embed)
         return
 
-    report = {}
-    for timestamp, staff_name, action_type, _, _ in punishments:
-        if timestamp >= weekly_start:
-            if staff_name not in report:
-                report[staff_name] = {'Ban': 0, 'Mute': 0, 'Shards': 0}
-            report[staff_name][action_type] += 1
-            points = 15 if action_type == 'Ban' else 20
-            if best_time_start and best_time_end and best_time_start <= timestamp <= best_time_end:
-                points *= 2
-            report[staff_name]['Shards'] += points
-
-    embed = discord.Embed(
-        title=f"{EMOJI_REPORT} Weekly Punishment Report",
-        description=f"From {weekly_start.strftime('%Y-%m-%d')} to now",
-        color=discord.Color.green()
-    )
-    for staff_name, counts in sorted(report.items()):
-        embed.add_field(
-            name=staff_name,
-            value=f"Bans: {counts['Ban']}\nMutes: {counts['Mute']}\nShards: {counts['Shards']}",
-            inline=True
-        )
-    if not report:
-        embed.add_field(name="No Data", value="No punishments recorded.", inline=False)
-    await ctx.send(embed=embed, ephemeral=True)
+    await send_report(ctx, state, ('weekly', state.weekly_start), state.weekly_start, None,
+                      f"{EMOJI_REPORT} Weekly Punishment Report", f"From {state.weekly_start.strftime('%Y-%m-%d')} to now")
 
-@bot.command(name='stagereport')
+@bot.hybrid_command(name='stagereport', description="Show punishment stats for the stage period")
 @check_staff_role()
 async def stage_report(ctx):
-    if not stage_start:
+    state = await get_state(ctx.guild.id)
+    if not state.stage_start:
         embed = discord.Embed(
             title=f"{EMOJI_ERROR} No Stage Period",
             description="Stage period is not set. Use .setstage to set it.",
             color=discord.Color.red()
         )
-        await ctx.send(embed=embed, ephemeral=True)
+        await send_private(ctx, embed=embed)
+        return
+
+    await send_report(ctx, state, ('stage', state.stage_start), state.stage_start, None,
+                      f"{EMOJI_REPORT} Stage Punishment Report", f"From {state.stage_start.strftime('%Y-%m-%d')} to now")
+
+# Gzipped CSV or JSONL split into numbered parts, each closed before it can outgrow the upload limit.
+class ExportWriter:
+    def __init__(self, prefix, export_format, max_bytes):
+        self.prefix = prefix
+        self.export_format = export_format
+        self.max_bytes = max(max_bytes - EXPORT_SIZE_MARGIN, EXPORT_SIZE_MARGIN)
+        self.parts = 0
+        self.path = None
+        self.raw = None
+        self.compressed = None
+
+    # Every CSV part starts with its own header row, so each file opens on its own.
+    def encode(self, rows, header):
+        if self.export_format == 'jsonl':
+            return ''.join(json.dumps(dict(zip(EXPORT_COLUMNS, (row[0].isoformat(),) + row[1:]))) + '\n' for row in rows)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(EXPORT_COLUMNS)
+        writer.writerows((row[0].isoformat(),) + row[1:] for row in rows)
+        return buffer.getvalue()
+
+    # Returns the parts that filled up, ready to upload; the one still being written stays open.
+    def write(self, rows):
+        header = self.compressed is None
+        if header:
+            self.parts += 1
+            self.path = f"{self.prefix}-{self.parts}.{self.export_format}.gz"
+            self.raw = open(self.path, 'wb')
+            self.compressed = gzip.GzipFile(fileobj=self.raw, mode='wb')
+        self.compressed.write(self.encode(rows, header).encode())
+        if self.raw.tell() >= self.max_bytes:
+            return [self.close()]
+        return []
+
+    def close(self):
+        if self.compressed is None:
+            return None
+        self.compressed.close()
+        self.raw.close()
+        self.compressed = self.raw = None
+        return self.path
+
+
+@bot.hybrid_command(name='export', description="Download punishments between two dates (YYYY-MM-DD) as gzipped files")
+@check_staff_role()
+@app_commands.rename(from_str='from', to_str='to', export_format='format')
+async def export(ctx, from_str: str, to_str: str, export_format: str = 'csv'):
+    start = parse_date(from_str)
+    end = parse_date(to_str)
+    if not start or not end or end < start or export_format not in EXPORT_FORMATS:
+        embed = discord.Embed(
+            title=f"{EMOJI_ERROR} Invalid Export",
+            description=f"Please provide two valid dates (YYYY-MM-DD), the first not after the second, and a format of {' or '.join(EXPORT_FORMATS)}.",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
         return
 
-    report = {}
-    for timestamp, staff_name, action_type, _, _ in punishments:
-        if timestamp >= stage_start:
-            if staff_name not in report:
-                report[staff_name] = {'Ban': 0, 'Mute': 0, 'Shards': 0}
-            report[staff_name][action_type] += 1
-            points = 15 if action_type == 'Ban' else 20
-            if best_time_start and best_time_end and best_time_start <= timestamp <= best_time_end:
-                points *= 2
-            report[staff_name]['Shards'] += points
+    await ctx.defer()
+    state = await get_state(ctx.guild.id)
+    loop = asyncio.get_running_loop()
+    exported = 0
+    parts = []
+    with tempfile.TemporaryDirectory(prefix='shard-manager-export-') as directory:
+        writer = ExportWriter(os.path.join(directory, f"punishments-{from_str}-{to_str}"), export_format, ctx.guild.filesize_limit)
+        try:
+            async for rows in state.export_batches(start, end + timedelta(days=1)):
+                rows = [(row[0], state.staff_name(row[1])) + row[1:] for row in rows]
+                # Encoding and compression run off the event loop; each finished part is uploaded and deleted straight away.
+                for path in await loop.run_in_executor(None, writer.write, rows):
+                    await ctx.send(file=discord.File(path))
+                    os.remove(path)
+                    parts.append(path)
+                exported += len(rows)
+        finally:
+            path = await loop.run_in_executor(None, writer.close)
+        if path:
+            await ctx.send(file=discord.File(path))
+            parts.append(path)
 
     embed = discord.Embed(
-        title=f"{EMOJI_REPORT} Stage Punishment Report",
-        description=f"From {stage_start.strftime('%Y-%m-%d')} to now",
+        title=f"{EMOJI_SUCCESS} Export Complete",
+        description=f"Exported {exported} punishments from {from_str} to {to_str} as {export_format} in {len(parts)} file(s).",
         color=discord.Color.green()
     )
-    for staff_name, counts in sorted(report.items()):
-        embed.add_field(
-            name=staff_name,
-            value=f"Bans: {counts['Ban']}\nMutes: {counts['Mute']}\nShards: {counts['Shards']}",
-            inline=True
-        )
-    if not report:
-        embed.add_field(name="No Data", value="No punishments recorded.", inline=False)
-    await ctx.send(embed=embed, ephemeral=True)
-
-def parse_log_message(content):
-    target_match = re.search(r'Target\s*\n(.*?)(?=\n[A-Z]|$)', content, re.DOTALL)
-    type_match = re.search(r'Type\s*\n(.*?)(?=\n[A-Z]|$)', content, re.DOTALL)
-    issued_by_match = re.search(r'Issued By\s*\n(.*?)(?=\n[A-Z]|$)', content, re.DOTALL)
-    
-    if target_match and type_match and issued_by_match:
-        return (
-            target_match.group(1).strip(),
-            type_match.group(1).strip(),
-            issued_by_match.group(1).strip()
-        )
-    return None
+    await ctx.send(embed=embed)
+
+LOG_FIELDS = ('Target', 'Type', 'Issued By')
+# Captures each label's value inside a lookahead so one findall still sees labels that sit inside another value.
+# The scan stays in the re engine: the same fields read line by line in Python are slower than the old three searches (benchmark.py parser).
+LOG_FIELD_PATTERN = re.compile(r'(Target|Type|Issued By)\s*\n(?=([^\n]*(?:\n(?![A-Z])[^\n]*)*))')
+
+
+def parse_log_message(content, embeds=()):
+    if not embeds and 'Issued By' not in content:
+        return None
+    values = {}
+    for label, value in LOG_FIELD_PATTERN.findall(content):
+        if label not in values:
+            values[label] = value.strip()
+    for embed in embeds:
+        for field in embed.fields:
+            name = (field.name or '').strip()
+            if name in LOG_FIELDS and name not in values:
+                values[name] = (field.value or '').strip()
+        if embed.description:
+            for label, value in LOG_FIELD_PATTERN.findall(embed.description):
+                if label not in values:
+                    values[label] = value.strip()
+
+    if len(values) < len(LOG_FIELDS):
+        return None
+    return values['Target'], values['Type'], values['Issued By']
 
 def parse_staff_update_message(content):
     mention_match = re.search(r'Mention\s*:\s*<@!?(\d+)>', content)
@@ -621,85 +3171,349 @@ def parse_staff_update_message(content):
 
 @bot.event
 async def on_message(message):
+    count('events_total', event='message')
+    with timed('handler_seconds', handler='message'):
+        await route_message(message)
+    await bot.process_commands(message)
+
+
+async def route_message(message):
+    # Guilds that never stored anything have no log channels to route, so their chatter never loads a state.
+    if message.guild is None or message.guild.id not in stored_guilds:
+        return
+    state = await get_state(message.guild.id)
   
-    if log_channel_id and message.channel.id == log_channel_id:
-        parsed = parse_log_message(message.content)
-        if parsed:
-            target, action_type, staff_name = parsed
-            if staff_name in staff_list and action_type in ['Ban', 'Mute']:
-             
-                points = 15 if action_type == 'Ban' else 20
-                if best_time_start and best_time_end:
-                    now = datetime.now()
-                    if best_time_start <= now <= best_time_end:
-                        points *= 2  
-                
-              
-                if staff_name not in staff_shards:
-                    staff_shards[staff_name] = 0
-                staff_shards[staff_name] += points
-                
-             
-                punishments.append((datetime.now(), staff_name, action_type, target, message.id))
-                
-          
-                guild = message.guild
-                link = f"https://discord.com/channels/{guild.id}/{message.channel.id}/{message.id}"
-                
-                
-                embed = discord.Embed(
-                    title=f"{EMOJI_SUCCESS} Punishment Logged",
-                    description=f"Staff {staff_name} earned {points} shards!",
-                    color=discord.Color.green()
-                )
-                embed.add_field(name="Action", value=action_type, inline=True)
-                embed.add_field(name="Target", value=target, inline=True)
-                embed.add_field(name="Total Shards", value=staff_shards[staff_name], inline=True)
-                embed.add_field(name="Log", value=f"[View Log]({link})", inline=False)
-                bot_log_channel = bot.get_channel(bot_log_channel_id)
-                if bot_log_channel:
-                    await bot_log_channel.send(embed=embed)
-                save_data_to_file()
+    if state.log_channel_id and message.channel.id == state.log_channel_id:
+        delay = max(0.0, (discord.utils.utcnow() - message.created_at).total_seconds())
+        metrics_gauges['log_delay_last_seconds'] = delay
+        observe('log_delay_seconds', delay)
+        counted = state.parse_counted_punishment(message)
+        logged = await state.write(state.log_message, message.id, counted, datetime.now())
+        if logged:
+            staff_id, action_type, target, points = logged
+      
+            guild = message.guild
+            link = f"https://discord.com/channels/{guild.id}/{message.channel.id}/{message.id}"
+            queue_punishment_log(state, staff_id, action_type, target, points, link)
 
  
-    if staff_update_channel_id and message.channel.id == staff_update_channel_id:
+    if state.staff_update_channel_id and message.channel.id == state.staff_update_channel_id:
         parsed = parse_staff_update_message(message.content)
         if parsed:
             user_id, mode, staff_type = parsed
-            try:
-               
-                try:
-                    member = await message.guild.fetch_member(user_id)
-                except discord.NotFound:
-                  
-                    member = discord.Object(id=user_id)
-                
-                if mode in ['Joined', 'ReJoin']:
-                    roles_to_assign = (
-                        DISCORD_STAFF_ROLES if staff_type == 'Discord' else
-                        MINECRAFT_STAFF_ROLES if staff_type == 'Minecraft' else
-                        []
-                    )
-                    if isinstance(member, discord.Member):
-                        for role_id in roles_to_assign:
-                            role = message.guild.get_role(role_id)
-                            if role:
-                                await member.add_roles(role, reason=f"Staff update: {mode} as {staff_type}")
-                            else:
-                                print(f"Role {role_id} not found for {mode} action")
-                elif mode == 'Blacklist':
-                    await message.guild.ban(member, reason="Staff update: Blacklisted")
-                elif mode == 'Demote':
-                    if isinstance(member, discord.Member):
-                        await message.guild.kick(member, reason="Staff update: Demoted")
+            staff_update_queues[user_id % STAFF_UPDATE_WORKERS].put_nowait((message.guild, user_id, mode, staff_type))
+
+
+async def with_retries(action, description):
+    for attempt in range(STAFF_UPDATE_RETRIES + 1):
+        try:
+            return await action()
+        except discord.HTTPException as e:
+            if attempt == STAFF_UPDATE_RETRIES or not (e.status == 429 or e.status >= 500):
+                raise
+            delay = min(30, 2 ** attempt) + random.uniform(0, 1)
+            print(f"HTTP {e.status} during {description}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+# Gateway cache first, then recent REST results (including "not in guild"), and only then the API.
+# A fresh lookup skips the REST results: their roles can be MEMBER_CACHE_TTL old, too stale to base a role edit on.
+async def resolve_member(guild, user_id, fresh=False):
+    member = guild.get_member(user_id)
+    if member:
+        member_cache_stats['gateway_hits'] += 1
+        return member
+
+    key = (guild.id, user_id)
+    cached = member_cache.get(key)
+    if cached and cached[0] > time.monotonic() and not fresh:
+        member_cache.move_to_end(key)
+        member_cache_stats['cache_hits' if cached[1] else 'not_found_hits'] += 1
+        return cached[1]
+
+    member_cache_stats['fetches'] += 1
+    try:
+        member = await with_retries(lambda: guild.fetch_member(user_id), f"fetch of member {user_id}")
+    except discord.NotFound:
+        member = None
+    member_cache[key] = (time.monotonic() + (MEMBER_CACHE_TTL if member else MEMBER_NOT_FOUND_TTL), member)
+    member_cache.move_to_end(key)
+    while len(member_cache) > MEMBER_CACHE_SIZE:
+        member_cache.popitem(last=False)
+    return member
+
+
+@bot.event
+async def on_member_join(member):
+    member_cache.pop((member.guild.id, member.id), None)
+
+
+@bot.event
+async def on_member_remove(member):
+    member_cache.pop((member.guild.id, member.id), None)
+
+
+@bot.event
+async def on_member_update(before, after):
+    member_cache.pop((after.guild.id, after.id), None)
+
+
+async def apply_staff_update(guild, user_id, mode, staff_type):
+    try:
+        # Roles are added by diffing against the member's current roles, so Joined and ReJoin never use a cached REST member.
+        member = await resolve_member(guild, user_id, fresh=mode in ['Joined', 'ReJoin']) or discord.Object(id=user_id)
+
+        if mode in ['Joined', 'ReJoin']:
+            roles_to_assign = (
+                DISCORD_STAFF_ROLES if staff_type == 'Discord' else
+                MINECRAFT_STAFF_ROLES if staff_type == 'Minecraft' else
+                []
+            )
+            if isinstance(member, discord.Member):
+                roles = []
+                for role_id in roles_to_assign:
+                    role = guild.get_role(role_id)
+                    if role:
+                        if role not in member.roles:
+                            roles.append(role)
                     else:
-                        print(f"Cannot kick {user_id}: User not in server")
-            except discord.Forbidden:
-                print(f"Permission error: Cannot perform action for user {user_id} (Mode: {mode})")
-            except discord.HTTPException as e:
-                print(f"HTTP error performing action for user {user_id} (Mode: {mode}): {e}")
+                        print(f"Role {role_id} not found for {mode} action")
+                if roles:
+                    # atomic=False sends all roles in one member edit instead of one request per role.
+                    await with_retries(
+                        lambda: member.add_roles(*roles, reason=f"Staff update: {mode} as {staff_type}", atomic=False),
+                        f"role update for {user_id}"
+                    )
+        elif mode == 'Blacklist':
+            await with_retries(lambda: guild.ban(member, reason="Staff update: Blacklisted"), f"ban of {user_id}")
+        elif mode == 'Demote':
+            if isinstance(member, discord.Member):
+                await with_retries(lambda: guild.kick(member, reason="Staff update: Demoted"), f"kick of {user_id}")
+            else:
+                print(f"Cannot kick {user_id}: User not in server")
+    except discord.Forbidden:
+        print(f"Permission error: Cannot perform action for user {user_id} (Mode: {mode})")
+    except discord.HTTPException as e:
+        print(f"HTTP error performing action for user {user_id} (Mode: {mode}): {e}")
+
+
+# One queue per worker; routing by user id keeps each member's updates in order while members run concurrently.
+staff_update_queues = [asyncio.Queue() for _ in range(STAFF_UPDATE_WORKERS)]
+
+
+async def staff_update_worker(queue):
+    while True:
+        update = await queue.get()
+        try:
+            with timed('handler_seconds', handler='staff_update'):
+                await apply_staff_update(*update)
+        except Exception as e:
+            print(f"Error applying staff update {update[1:]}: {e}")
+        finally:
+            queue.task_done()
+
+
+async def reconcile_deleted(state, message_id):
+    punishment = await state.write(state.delete_punishment, message_id)
+    if punishment:
+        print(f"Log message {message_id} deleted, reversed {punishment[5]} shards for {state.staff_name(punishment[1])}")
+
+
+async def log_channel_state(guild_id, channel_id):
+    if guild_id is None or guild_id not in stored_guilds:
+        return None
+    state = await get_state(guild_id)
+    return state if state.log_channel_id and channel_id == state.log_channel_id else None
+
+
+@bot.event
+async def on_raw_message_delete(payload):
+    state = await log_channel_state(payload.guild_id, payload.channel_id)
+    if state:
+        await reconcile_deleted(state, payload.message_id)
+
+
+@bot.event
+async def on_raw_bulk_message_delete(payload):
+    state = await log_channel_state(payload.guild_id, payload.channel_id)
+    if state:
+        for message_id in payload.message_ids:
+            await reconcile_deleted(state, message_id)
+
+
+@bot.event
+async def on_raw_message_edit(payload):
+    state = await log_channel_state(payload.guild_id, payload.channel_id)
+    if not state:
+        return
+    counted = state.parse_counted_punishment(payload.message)
+    if not await state.write(state.edit_punishment, payload.message, counted):
+        return
+    print(f"Log message {payload.message_id} edited, punishment {'updated' if counted else 'removed'}")
+
+
+def local_time(aware):
+    return aware.astimezone().replace(tzinfo=None)
+
+
+async def known_message_ids(state, after):
+    since = local_time(discord.utils.snowflake_time(after.id)) if isinstance(after, discord.Object) else after
+    # A day of slack covers clock skew between Discord's snowflakes and our local receive times.
+    since -= timedelta(days=1)
+    archived = await asyncio.get_running_loop().run_in_executor(None, state.archived_rows, since, datetime.max)
+    return {p[4] for p in archived} | {p[4] for p in await state.fetch_punishments(since, datetime.max)}
+
+
+async def ingest_backfill_batch(state, batch, known):
+    with timed('handler_seconds', handler='backfill_batch'):
+        return await ingest_backfill_messages(state, batch, known)
+
+
+async def ingest_backfill_messages(state, batch, known):
+    # The batch is parsed before it is queued; only the duplicate checks and the writes take the writer, once per batch.
+    counted = [(message, None if message.id in known else state.parse_counted_punishment(message)) for message in batch]
+    return await state.write(log_backfill_batch, state, counted, known)
+
+
+async def log_backfill_batch(state, counted, known):
+    logged = skipped = 0
+    for message, punishment in counted:
+        if message.id in known:
+            skipped += 1
+        elif await state.log_punishment(message.id, punishment, local_time(message.created_at)):
+            known.add(message.id)
+            logged += 1
+        state.advance_checkpoint(message.id)
+    state.configure(backfill_cursor=counted[-1][0].id)
+    return logged, skipped
+
+
+async def run_backfill(state, channel, after):
+    # Anything newer than this arrives through on_message, so the two paths never race on a message.
+    until = discord.Object(id=discord.utils.time_snowflake(discord.utils.utcnow()))
+    known = await known_message_ids(state, after)
+    scanned = logged = skipped = 0
+    batch = []
+    async for message in channel.history(limit=None, after=after, before=until, oldest_first=True):
+        batch.append(message)
+        if len(batch) >= BACKFILL_BATCH_SIZE:
+            batch_logged, batch_skipped = await ingest_backfill_batch(state, batch, known)
+            scanned, logged, skipped = scanned + len(batch), logged + batch_logged, skipped + batch_skipped
+            batch = []
+            await asyncio.sleep(0)
+    if batch:
+        batch_logged, batch_skipped = await ingest_backfill_batch(state, batch, known)
+        scanned, logged, skipped = scanned + len(batch), logged + batch_logged, skipped + batch_skipped
+    await state.write(state.configure, backfill_cursor=None)
+    print(f"Backfill finished: {scanned} messages scanned, {logged} punishments logged, {skipped} already known")
+    return scanned, logged, skipped
+
+
+def start_backfill(state, channel, after):
+    state.backfill_task = asyncio.get_running_loop().create_task(run_backfill(state, channel, after))
+    return state.backfill_task
+
+
+def report_backfill_error(task):
+    if not task.cancelled() and task.exception():
+        print(f"Error during startup backfill: {task.exception()}")
+
+
+@bot.hybrid_command(name='backfill', description="Re-read the punishment log channel from a date (YYYY-MM-DD) or the last checkpoint")
+@check_staff_role()
+@app_commands.rename(since_str='since')
+async def backfill(ctx, since_str: str = None):
+    state = await get_state(ctx.guild.id)
+    channel = bot.get_channel(state.log_channel_id) if state.log_channel_id else None
+    if since_str:
+        after = parse_date(since_str)
+    elif state.backfill_cursor or state.log_checkpoint:
+        after = discord.Object(id=state.backfill_cursor or state.log_checkpoint)
+    else:
+        after = None
+
+    if channel is None or after is None:
+        embed = discord.Embed(
+            title=f"{EMOJI_ERROR} Cannot Backfill",
+            description="Set a punishment log channel and give a valid date (YYYY-MM-DD), or wait for a checkpoint to exist.",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
+        return
+    if state.backfill_task and not state.backfill_task.done():
+        embed = discord.Embed(
+            title=f"{EMOJI_ERROR} Backfill Running",
+            description="A backfill is already in progress.",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
+        return
+
+    embed = discord.Embed(
+        title=f"{EMOJI_TIME} Backfill Started",
+        description=f"Reading {channel.mention} history...",
+        color=discord.Color.green()
+    )
+    await ctx.send(embed=embed)
+    try:
+        scanned, logged, skipped = await start_backfill(state, channel, after)
+    except discord.Forbidden:
+        embed = discord.Embed(
+            title=f"{EMOJI_ERROR} Permission Error",
+            description="Bot lacks permission to read that channel's history.",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
+        return
+    embed = discord.Embed(
+        title=f"{EMOJI_SUCCESS} Backfill Complete",
+        description=f"Scanned {scanned} messages, logged {logged} punishments, skipped {skipped} already recorded.",
+        color=discord.Color.green()
+    )
+    await ctx.send(embed=embed)
+
+
+def cluster_shard_ids(workers, shard_count):
+    workers = min(workers, shard_count)
+    return [list(range(shard_count * worker // workers, shard_count * (worker + 1) // workers)) for worker in range(workers)]
 
-    await bot.process_commands(message)
 
+# Discord sends a guild's events to shard (guild_id >> 22) % shard_count, so every guild belongs to exactly one
+# worker and that worker is the only writer of the guild's directory.
+def launch_cluster(workers, shard_count, command=None, cwd=None):
+    command = command or [sys.executable, os.path.abspath(__file__)]
+    processes = []
+    for shard_ids in cluster_shard_ids(workers, shard_count):
+        env = dict(os.environ, SHARD_MANAGER_SHARD_COUNT=str(shard_count), SHARD_MANAGER_SHARD_IDS=','.join(map(str, shard_ids)))
+        processes.append(subprocess.Popen(command, env=env, cwd=cwd))
+        print(f"Started worker {processes[-1].pid} for shards {shard_ids[0]}-{shard_ids[-1]} of {shard_count}")
+    try:
+        return [process.wait() for process in processes]
+    finally:
+        # SIGTERM closes a worker's bot and its final save runs; only a worker still up after the grace period is killed.
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for process in processes:
+            try:
+                process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                print(f"Worker {process.pid} did not stop within {WORKER_STOP_TIMEOUT}s; killing it")
+                process.kill()
+                process.wait()
 
-bot.run('MTQ0MzcxNjA3NDIzODM4MjIyMg.G3RBP0._u5XfkZYABVynJ92QPznefEhMUgseZMf-WaFhY')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Shard Manager Discord bot")
+    parser.add_argument('--cluster', type=int, default=0, metavar='WORKERS', help="Run WORKERS processes, each owning a range of gateway shards")
+    parser.add_argument('--shards', type=int, default=0, help="Total gateway shard count for --cluster (defaults to WORKERS)")
+    args = parser.parse_args()
+    if args.cluster:
+        # docker stop and systemd signal only the launcher; exiting through launch_cluster stops the workers the same graceful way.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        sys.exit(max(launch_cluster(args.cluster, args.shards or args.cluster)))
+    try:
+        bot.run('MTQ0MzcxNjA3NDIzODM4MjIyMg.G3RBP0._u5XfkZYABVynJ92QPznefEhMUgseZMf-WaFhY')
+    finally:
+        save_all_states()